@@ -6,7 +6,22 @@ from circuits.protocols.irc import (
     NOTICE, PART, PRIVMSG, TOPIC, QUIT
 )
 
-from pancakesbot.events import enqueue_msg
+from pancakesbot.events import enqueue_msg, queue_mode
+from pancakesbot.outbound import BULK, REPLY
+
+
+def _nick(user):
+    """Nick of a User, or user itself if it is already a nick"""
+    if isinstance(user, str):
+        return user
+    return user[0]
+
+
+def _ban_mask(user):
+    """*!*@host mask banning a User, or user itself if it is a mask"""
+    if isinstance(user, str):
+        return user
+    return "*!*@{}".format(user[2])
 
 
 class BasePlugin(Component):
@@ -19,26 +34,39 @@ class BasePlugin(Component):
 
     # Commands
     def ban(self, channel, user):
-        if isinstance(user, tuple):
-            self.mode(channel, '+b', "*!*@{}".format(user[2]))
-        else:
-            self.mode(channel, '+b', user)
+        self.mode(channel, '+b', _ban_mask(user))
+
+    def congested(self, target=None):
+        """True if output to target, or to anyone, is backing up.
+
+        Check before producing a lot of output, which would otherwise be
+        dropped once the send queue is full.
+        """
+        if target is not None:
+            target = _nick(target)
+        return self.bot.send_queue.congested(target)
 
     def deop(self, channel, user):
-        if isinstance(user, tuple):
-            self.mode(channel, '-o', user[0])
-        else:
-            self.mode(channel, '-o', user)
+        self.mode(channel, '-o', _nick(user))
 
     def devoice(self, channel, user):
-        if isinstance(user, tuple):
-            self.mode(channel, '-v', user[0])
-        else:
-            self.mode(channel, '-v', user)
+        self.mode(channel, '-v', _nick(user))
+
+    def ignore(self, mask):
+        """Stops the bot from passing on messages from users matching mask"""
+        self.bot.ignore_list.add(mask)
 
     def invite(self, nickname, channel):
         self.fire(INVITE(nickname, channel), self.bot_channel)
 
+    def is_banned(self, channel, user):
+        """Returns the ban masks in channel matching user"""
+        return self.bot.banned_masks(channel, user)
+
+    def is_on(self, channel, user):
+        """True if user (nick or user tuple) is in channel"""
+        return self.bot.roster.is_on(channel, _nick(user))
+
     def join(self, channels, keys=None):
         self.fire(JOIN(channels, keys), self.bot_channel)
 
@@ -50,17 +78,42 @@ class BasePlugin(Component):
             line = "\x01ACTION {}\x01".format(line)
             self.msg(target, line)
 
+    def members(self, channel):
+        """Full users (nick, ident, host, id) in channel"""
+        return self.bot.roster.members(channel)
+
     def mode(self, target, mode, *args):
+        """Sets modes on target.
+
+        Single channel mode changes such as '+o', nick are batched with
+        others made shortly after, and sent packed into as few MODE lines
+        as the server allows. Anything else sent to the channel, such as
+        a KICK after a ban, sends the pending batch first.
+        """
+        if (target.startswith('#') and len(mode) == 2 and
+                mode[0] in '+-' and len(args) <= 1):
+            self.fire(queue_mode(target, mode, *args), self.bot_channel)
+            return
         args = ' '.join(args)
-        print(args)
         self.fire(MODE(target, mode, args), self.bot_channel)
 
-    def msg(self, target, message):
-        for line in message.split('\n'):
-            if isinstance(target, tuple):
-                self.fire(enqueue_msg(target[0], line), self.bot_channel)
+    def msg(self, target, message, priority=None, coalesce=False):
+        """Queues message to target, a line at a time.
+
+        The first line goes in the REPLY lane and any further lines in the
+        BULK lane, so long output drains behind other replies, unless a
+        pancakesbot.outbound priority is given for all of them. With
+        coalesce, short lines may be sent joined up on fewer lines, and
+        all of them go in the REPLY lane by default.
+        """
+        target = _nick(target)
+        for number, line in enumerate(message.split('\n')):
+            if priority is not None:
+                lane = priority
             else:
-                self.fire(enqueue_msg(target, line), self.bot_channel)
+                lane = REPLY if number == 0 or coalesce else BULK
+            self.fire(enqueue_msg(target, line, lane, coalesce),
+                      self.bot_channel)
 
     def nick(self, nickname, hopcount=None):
         self.bot.nick = nickname
@@ -71,10 +124,7 @@ class BasePlugin(Component):
             self.fire(NOTICE(receivers, line), self.bot_channel)
 
     def op(self, channel, user):
-        if isinstance(user, tuple):
-            self.mode(channel, '+o', user[0])
-        else:
-            self.mode(channel, '+o', user)
+        self.mode(channel, '+o', _nick(user))
 
     def part(self, channels, message=None):
         print(message)
@@ -83,17 +133,17 @@ class BasePlugin(Component):
         else:
             self.fire(PART(channels, message), self.bot_channel)
 
-    def reply(self, user, target, message):
+    def reply(self, user, target, message, coalesce=False):
         """Simplified msg that will respond to user or channel,
         whichever a message was sent from"""
-        for line in message.split('\n'):
-            if target.startswith("#"):
-                self.msg(target, line)
-            else:
-                if isinstance(target, tuple):
-                    self.msg(user[0], line)
-                else:
-                    self.msg(user, line)
+        if target.startswith("#"):
+            self.msg(target, message, coalesce=coalesce)
+        else:
+            self.msg(user, message, coalesce=coalesce)
+
+    def status(self, channel, user):
+        """Prefix modes (e.g. {'o', 'v'}) user has in channel"""
+        return self.bot.roster.modes(channel, _nick(user))
 
     def topic(self, channel, topic=None):
         self.fire(TOPIC(channel, topic), self.bot_channel)
@@ -102,14 +152,11 @@ class BasePlugin(Component):
         self.fire(QUIT(message), self.bot_channel)
         raise SystemExit(0)
 
+    def unignore(self, mask):
+        return self.bot.ignore_list.remove(mask)
+
     def unban(self, channel, user):
-        if isinstance(user, tuple):
-            self.mode(channel, '-b', "*!*@{}".format(user[2]))
-        else:
-            self.mode(channel, '-b', user)
+        self.mode(channel, '-b', _ban_mask(user))
 
     def voice(self, channel, user):
-        if isinstance(user, tuple):
-            self.mode(channel, '+v', user[0])
-        else:
-            self.mode(channel, '+v', user)
+        self.mode(channel, '+v', _nick(user))
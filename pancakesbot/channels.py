@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from pancakesbot.hostmask import irc_lower
+from pancakesbot.modes import DEFAULT_PREFIXES
+
+
+class ChannelRoster:
+    """Live view of who is in each channel the bot is in.
+
+    Built from WHO replies and JOIN, PART, QUIT, KICK, NICK and MODE
+    events, so known nicks resolve to full users and membership or
+    status questions are answered from memory. Nicks and channels are
+    compared using IRC casemapping.
+    """
+
+    def __init__(self, prefixes=DEFAULT_PREFIXES):
+        # irc_lower(nick): (nick, ident, host, user id)
+        self.users = {}
+        # irc_lower(channel): {irc_lower(nick): set of prefix modes}
+        self.channels = {}
+        self.set_prefixes(prefixes)
+
+    def set_prefixes(self, prefixes):
+        """Sets the (mode, prefix) pairs the server uses, highest first"""
+        self.prefixes = tuple(prefixes)
+        self.prefix_modes = dict((prefix, mode)
+                                 for mode, prefix in self.prefixes)
+
+    def clear(self):
+        self.users.clear()
+        self.channels.clear()
+
+    # Queries
+
+    def user(self, nick):
+        """(nick, ident, host, user id) of a nick we share a channel with"""
+        return self.users.get(irc_lower(nick))
+
+    def is_on(self, channel, nick):
+        members = self.channels.get(irc_lower(channel))
+        return members is not None and irc_lower(nick) in members
+
+    def modes(self, channel, nick):
+        """Prefix modes (e.g. {'o', 'v'}) nick has in channel"""
+        members = self.channels.get(irc_lower(channel))
+        if members is None:
+            return frozenset()
+        return frozenset(members.get(irc_lower(nick), ()))
+
+    def has_mode(self, channel, nick, mode):
+        members = self.channels.get(irc_lower(channel))
+        return (members is not None and
+                mode in members.get(irc_lower(nick), ()))
+
+    def prefix(self, channel, nick):
+        """Highest status prefix (e.g. '@') nick has in channel, or ''"""
+        modes = self.modes(channel, nick)
+        for mode, prefix in self.prefixes:
+            if mode in modes:
+                return prefix
+        return ''
+
+    def members(self, channel):
+        """Full users in channel"""
+        members = self.channels.get(irc_lower(channel), ())
+        return [self.users[key] for key in members]
+
+    def channels_of(self, nick):
+        key = irc_lower(nick)
+        return [channel for channel, members in self.channels.items()
+                if key in members]
+
+    # Updates
+
+    def add(self, channel, user, modes=()):
+        """Adds user (nick, ident, host, id) to channel"""
+        key = irc_lower(user[0])
+        self.users[key] = user
+        members = self.channels.setdefault(irc_lower(channel), {})
+        members.setdefault(key, set()).update(modes)
+
+    def who_reply(self, channel, user, flags):
+        """Adds a WHO reply member, whose flags look like "H@+" or "G*" """
+        modes = [self.prefix_modes[flag] for flag in flags
+                 if flag in self.prefix_modes]
+        self.add(channel, user, modes)
+
+    def remove(self, channel, nick):
+        """nick left channel, by PART or KICK"""
+        key = irc_lower(nick)
+        members = self.channels.get(irc_lower(channel))
+        if members is not None:
+            members.pop(key, None)
+        self._forget_if_unseen(key)
+
+    def drop_channel(self, channel):
+        """We left channel; forget its members unless seen elsewhere"""
+        members = self.channels.pop(irc_lower(channel), {})
+        for key in members:
+            self._forget_if_unseen(key)
+
+    def quit(self, nick):
+        key = irc_lower(nick)
+        for members in self.channels.values():
+            members.pop(key, None)
+        self.users.pop(key, None)
+
+    def rename(self, old_nick, user):
+        """old_nick is now known as user (new nick, ident, host, id)"""
+        old_key = irc_lower(old_nick)
+        new_key = irc_lower(user[0])
+        if old_key not in self.users:
+            return
+        del self.users[old_key]
+        self.users[new_key] = user
+        for members in self.channels.values():
+            if old_key in members:
+                members[new_key] = members.pop(old_key)
+
+    def set_mode(self, channel, nick, mode, adding=True):
+        members = self.channels.get(irc_lower(channel))
+        if members is None:
+            return
+        modes = members.get(irc_lower(nick))
+        if modes is None:
+            return
+        if adding:
+            modes.add(mode)
+        else:
+            modes.discard(mode)
+
+    def _forget_if_unseen(self, key):
+        for members in self.channels.values():
+            if key in members:
+                return
+        self.users.pop(key, None)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from inspect import getdoc
+
+# Most "did you mean" suggestions offered at once
+MAX_SUGGESTIONS = 5
+
+
+class Command:
+    """A command or alias in the command index"""
+
+    __slots__ = ('name', 'plugin', 'handler', 'help', 'threaded', 'timeout')
+
+    def __init__(self, name, plugin, handler):
+        self.name = name
+        # Fully qualified plugin module, e.g. plugins.example
+        self.plugin = plugin
+        # Bound method, called with (user, target, args)
+        self.handler = handler
+        doc = getdoc(handler)
+        self.help = ("{}: {}".format(name, doc) if doc
+                     else "No help text.")
+        # Run in the command pool rather than the event loop
+        self.threaded = getattr(handler, 'threaded', False)
+        # Seconds a threaded command may run, None for the default
+        self.timeout = getattr(handler, 'timeout', None)
+
+    def __repr__(self):
+        return "<Command {} ({})>".format(self.name, self.plugin)
+
+
+class CommandJob:
+    """A threaded command call, from submission until it is answered"""
+
+    __slots__ = ('command', 'user', 'target', 'future', 'timer', 'abandoned')
+
+    def __init__(self, command, user, target, future):
+        self.command = command
+        self.user = user
+        self.target = target
+        self.future = future
+        # Timer firing command_timeout, if the command has a timeout
+        self.timer = None
+        # Timed out or unloaded while running, its result is discarded
+        self.abandoned = False
+
+    def __repr__(self):
+        return "<CommandJob {} for {}@{}>".format(self.command.name,
+                                                  self.user[0],
+                                                  self.target)
+
+
+class _Node:
+    __slots__ = ('children', 'names')
+
+    def __init__(self):
+        self.children = {}
+        # Every command name below this node, sorted
+        self.names = []
+
+
+class CommandTrie:
+    """Prefix trie of command names.
+
+    Each node keeps the sorted names that pass through it, so finding
+    everything a prefix could stand for costs the length of the prefix.
+    """
+
+    def __init__(self, names=()):
+        self._root = _Node()
+        for name in sorted(names):
+            self._add(name)
+
+    def _add(self, name):
+        node = self._root
+        node.names.append(name)
+        for char in name:
+            node = node.children.setdefault(char, _Node())
+            node.names.append(name)
+
+    def _walk(self, word):
+        """Deepest node along word, and how many characters it matched"""
+        node = self._root
+        depth = 0
+        for char in word:
+            child = node.children.get(char)
+            if child is None:
+                break
+            node = child
+            depth += 1
+        return node, depth
+
+    def complete(self, prefix):
+        """Sorted names starting with prefix"""
+        node, depth = self._walk(prefix)
+        if depth < len(prefix):
+            return []
+        return list(node.names)
+
+    def suggest(self, word):
+        """Names sharing a good part of word's start, for a mistyped word.
+
+        At least two characters, and half of word, have to match.
+        """
+        node, depth = self._walk(word)
+        if depth < 2 or depth * 2 < len(word):
+            return []
+        return node.names[:MAX_SUGGESTIONS]
+
+
+class ParsedCommand:
+    """A message recognized as a command, parsed once and shared with
+    every plugin through the on_command event.
+    """
+
+    __slots__ = ('trigger', 'name', 'text', 'args', 'prefixed', 'addressed',
+                 'admin')
+
+    def __init__(self, trigger, name, text, prefixed=False, addressed=False,
+                 admin=False):
+        # What the message started with, e.g. '~' or 'pancakesbot: '
+        self.trigger = trigger
+        self.name = name
+        # Everything after the command name
+        self.text = text
+        self.args = text.split(' ') if text else []
+        # Started with the command prefix
+        self.prefixed = prefixed
+        # Started with the bot's nick
+        self.addressed = addressed
+        # Started with the admin prefix
+        self.admin = admin
+
+    def __repr__(self):
+        return "<ParsedCommand {!r} {!r}>".format(
+            self.trigger + self.name, self.text)
+
+
+class CommandRecognizer:
+    """Tells commands from chatter, and splits them into ParsedCommands.
+
+    Every trigger a command may start with is kept in one tuple, so a
+    message that isn't a command costs a single startswith() call. The
+    nick triggers are rebuilt only when the nick passed in changes.
+    """
+
+    def __init__(self, command_prefix, admin_prefix=None, nick=None):
+        self.command_prefix = command_prefix
+        self.admin_prefix = admin_prefix
+        self._nick = None
+        self._nick_triggers = ()
+        self._triggers = ()
+        self.set_nick(nick)
+
+    def set_nick(self, nick):
+        self._nick = nick
+        self._nick_triggers = ((nick + ': ', nick + ', ') if nick
+                               else ())
+        # Longest first, so a nick isn't mistaken for a prefix it starts with
+        self._triggers = tuple(sorted(
+            set(self._nick_triggers +
+                tuple(prefix for prefix in (self.command_prefix,
+                                            self.admin_prefix) if prefix)),
+            key=len, reverse=True))
+
+    def parse(self, message, nick=None):
+        """ParsedCommand for message, or None if it isn't a command"""
+        if nick is not None and nick != self._nick:
+            self.set_nick(nick)
+        if not message.startswith(self._triggers):
+            return None
+        for trigger in self._triggers:
+            if message.startswith(trigger):
+                break
+        name, _, text = message[len(trigger):].partition(' ')
+        if not name:
+            return None
+        return ParsedCommand(trigger, name, text,
+                             prefixed=trigger == self.command_prefix,
+                             addressed=trigger in self._nick_triggers,
+                             admin=trigger == self.admin_prefix)
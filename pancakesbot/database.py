@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.request import pathname2url
+
+
+class DBExecutor:
+    """Runs sqlite work off the circuits event loop.
+
+    A single writer thread owns the read/write connection, so writes are
+    serialized in submission order. Lookups run on a pool of read-only
+    connections, which WAL mode lets proceed while the writer commits.
+    Both write() and read() return concurrent.futures.Future objects and
+    call fn(connection, *args) on their worker thread.
+    """
+
+    def __init__(self, dbfile, readers=2, setup=None):
+        self.logger = logging.getLogger(__name__)
+        self.dbfile = dbfile
+        self._jobs = queue.Queue()
+        self._local = threading.local()
+
+        ready = Future()
+        self._writer = threading.Thread(target=self._write_loop,
+                                        args=(ready, setup),
+                                        name="db-writer",
+                                        daemon=True)
+        self._writer.start()
+        # Surface connection and setup errors to the caller
+        ready.result()
+
+        # An in-memory database only exists on the writer's connection
+        if dbfile == ':memory:' or readers <= 0:
+            self._readers = None
+        else:
+            self._readers = ThreadPoolExecutor(
+                max_workers=readers,
+                thread_name_prefix="db-reader")
+
+    def _connect_writer(self):
+        conn = sqlite3.connect(self.dbfile)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL only needs to sync on checkpoints to stay consistent
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _write_loop(self, ready, setup):
+        try:
+            conn = self._connect_writer()
+            if setup is not None:
+                setup(conn)
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(True)
+
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            future, fn, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(conn, *args))
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                future.set_exception(e)
+        conn.close()
+
+    def _reader_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            uri = 'file:{}?mode=ro'.format(
+                pathname2url(os.path.abspath(self.dbfile)))
+            conn = sqlite3.connect(uri, uri=True)
+            self._local.conn = conn
+        return conn
+
+    def _read_job(self, fn, args):
+        return fn(self._reader_conn(), *args)
+
+    def write(self, fn, *args):
+        """Queues fn(conn, *args) on the writer thread"""
+        future = Future()
+        self._jobs.put((future, fn, args))
+        return future
+
+    def read(self, fn, *args):
+        """Runs fn(conn, *args) on a read-only connection"""
+        if self._readers is None:
+            return self.write(fn, *args)
+        return self._readers.submit(self._read_job, fn, args)
+
+    def close(self):
+        """Finishes queued writes and stops the worker threads"""
+        self._jobs.put(None)
+        self._writer.join()
+        if self._readers is not None:
+            self._readers.shutdown(wait=True)
@@ -13,8 +13,99 @@ class terminate(Event):
 class enqueue_msg(Event):
     """enqueue_msg Event
     Add message to queue.
+    Args:
+        target - string - Channel or User to send the message to.
+        message - string - A single line of text.
+        priority - int - Optional pancakesbot.outbound lane, REPLY
+                         by default.
+        coalesce - bool - Optional, True lets the line merge with other
+                          short lines queued for target. False by default.
+    """
+
+
+class queue_mode(Event):
+    """queue_mode Event
+    Add a channel mode change to the next batch of MODE lines.
+    Args:
+        channel - string - Channel to change the mode of.
+        mode - string - A single change, e.g. '+o'.
+        param - string - Optional mode parameter, e.g. a nick.
+    """
+
+
+class plugin_host_ready(Event):
+    """plugin_host_ready Event
+    A plugin host loaded its plugin.
+    Args:
+        host - PluginHost - The host that started.
+        reply - tuple - Its READY message.
+    """
+
+
+class plugin_host_failed(Event):
+    """plugin_host_failed Event
+    A plugin host didn't start, or exited without being asked to.
+    Args:
+        host - PluginHost - The host that failed.
+        reason - string - What happened.
+    """
+
+
+class plugin_host_done(Event):
+    """plugin_host_done Event
+    A command finished in a plugin host.
+    Args:
+        host - PluginHost - The host that ran it.
+        call_id - int - The call that finished.
+    """
+
+
+class plugin_host_timeout(Event):
+    """plugin_host_timeout Event
+    A command ran past its timeout in a plugin host.
+    Args:
+        host - PluginHost - The host running it.
+        call_id - int - The call that timed out.
     """
 
+
+class command_done(Event):
+    """command_done Event
+    A threaded command finished in the command pool.
+    Args:
+        job - CommandJob - The command call that finished.
+    """
+
+
+class command_timeout(Event):
+    """command_timeout Event
+    A threaded command ran past its timeout.
+    Args:
+        job - CommandJob - The command call that timed out.
+    """
+
+
+class who_found(Event):
+    """who_found Event
+    The user DB lookups for a channel's WHO replies are done.
+    Args:
+        channel - string - The channel the WHO was for.
+        started - float - perf_counter() when the WHO was sent.
+        users - list - ((nick, ident, host), flags) per reply.
+        found - Future - The UserManager.lookup_users() of the users.
+    """
+
+
+class nick_found(Event):
+    """nick_found Event
+    The user DB lookups for a nick change are done.
+    Args:
+        user - tuple - (nickname, ident, hostname) before the change.
+        new_nick - string - The nick user changed to.
+        found - Future - The UserManager.lookup_users() of the user.
+    """
+
+
 #################
 # Plugin Events #
 #################
@@ -24,7 +115,7 @@ class on_action(Event):
     """on_action Event
     /me or /describe event received.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         target - string - Channel or User that is the target of the message.
         message - string - Full message received.
     """
@@ -34,12 +125,24 @@ class on_ban(Event):
     """on_ban Event
     User banned from a channel
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         target - string - Banned target.
         channel - string - Channel target is banned from.
     """
 
 
+class on_command(Event):
+    """on_command Event
+    Received a message starting with the command prefix, the admin prefix
+    or the bot's nick. Fired once per message, after on_text.
+    Args:
+        user - User - (nickname, ident, hostname, user id)
+        target - string - Channel or User that is the target of the message.
+        command - ParsedCommand - trigger, name, text and args of the
+            command, and whether it was prefixed, addressed or admin.
+    """
+
+
 class on_connect(Event):
     """on_connect Event
     Successfully connected to IRC server and recieved it's MOTD.
@@ -53,8 +156,8 @@ class on_deop(Event):
     """on_deop Event
     User has taken away operator privileges from target in channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
-        target - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
+        target - User - (nickname, ident, hostname, user id)
         channel - string - Channel target is no longer operator of.
     """
 
@@ -63,8 +166,8 @@ class on_deowner(Event):
     """on_deowner Event
     User has taken away owner privileges from target in channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
-        target - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
+        target - User - (nickname, ident, hostname, user id)
         channel - string - Channel target is no longer owner of.
     """
 
@@ -73,8 +176,8 @@ class on_devoice(Event):
     """on_devoice Event
     User has taken away voice privileges from target in channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
-        target - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
+        target - User - (nickname, ident, hostname, user id)
         channel - string - Channel target is no longer voiced in.
     """
 
@@ -101,7 +204,7 @@ class on_invite(Event):
     """on_invite Event
     Received invite to join a channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         channel - string - Channel we've been invited to.
     """
 
@@ -110,7 +213,7 @@ class on_join(Event):
     """on_join Event
      User joined a channel.
      Args:
-         user - tuple - (nickname, ident, hostname, user id)
+         user - User - (nickname, ident, hostname, user id)
          channel - string - Channel target was kicked from.
      """
 
@@ -119,8 +222,8 @@ class on_kick(Event):
     """on_kick Event
     User kicked from a channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
-        target - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
+        target - User - (nickname, ident, hostname, user id)
         channel - string - Channel target was kicked from.
         message - string - Kick message.
     """
@@ -139,17 +242,30 @@ class on_mode(Event):
     """on_mode Event
     A channel mode has been changed.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         mode - string - Channel or user mode set.
         target - string - Chennel or Nickname affected.
     """
 
 
+class on_modes(Event):
+    """on_modes Event
+    One or more channel modes have been changed by a single MODE line.
+    Fired after the per-mode events.
+    Args:
+        user - User - (nickname, ident, hostname, user id)
+        channel - string - Channel the modes were changed in.
+        changes - list - [(mode, param), ...] e.g. ('+o', target), where
+                         param is the target User for status modes, a
+                         string such as a ban mask or key, or None.
+    """
+
+
 class on_nick(Event):
     """on_nick Event
     A user in a channel has changed their nick.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         new_nick - string - The new nickname.
     """
 
@@ -158,7 +274,7 @@ class on_notice(Event):
     """on_notice Event
     Received a notice message.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         target - string - Channel or User that is the target of the message.
         message - string - Full message received.
     """
@@ -168,8 +284,8 @@ class on_op(Event):
     """on_op Event
     User has given target operator privileges in channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
-        target - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
+        target - User - (nickname, ident, hostname, user id)
         channel - string - Channel target is operator of.
     """
 
@@ -178,8 +294,8 @@ class on_owner(Event):
     """on_owner Event
     User has given owner privileges from target in channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
-        target - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
+        target - User - (nickname, ident, hostname, user id)
         channel - string - Channel target is owner of.
     """
 
@@ -188,7 +304,7 @@ class on_part(Event):
     """on_part Event
     A user in a channel has parted the channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         channel - string - Channel that the user parted from.
         message - string - Part message.
     """
@@ -198,7 +314,7 @@ class on_quit(Event):
     """on_quit Event
     A user in a channel has quit IRC.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         message - string - Quit message.
     """
 
@@ -213,7 +329,7 @@ class on_text(Event):
     """on_text Event
     Received private or channel message.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         target - string - Channel or User that is the target of the message.
         message - string - Full message received.
     """
@@ -223,7 +339,7 @@ class on_topic(Event):
     """on_topic Event
     A user has changed the topic of a channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         channel - string - Channel that the topic was changed.
         topic - string - The new topic.
     """
@@ -233,7 +349,7 @@ class on_unban(Event):
     """on_unban Event
     A user has been unbaned from a channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
         target - string - Unbanned target.
         channel - string - Channel target is unbanned from.
     """
@@ -243,7 +359,7 @@ class on_voice(Event):
     """on_voice Event
     User has given target voice privileges in channel.
     Args:
-        user - tuple - (nickname, ident, hostname, user id)
-        target - tuple - (nickname, ident, hostname, user id)
+        user - User - (nickname, ident, hostname, user id)
+        target - User - (nickname, ident, hostname, user id)
         channel - string - Channel target is voiced in.
     """
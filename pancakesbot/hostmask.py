@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+# RFC 1459 casemapping: []\~ are the uppercase forms of {}|^
+_RFC1459_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+                               'abcdefghijklmnopqrstuvwxyz{}|^')
+_WILDCARDS = re.compile(r'[*?]')
+
+
+def irc_lower(text):
+    """Lowercases text using IRC (RFC 1459) casemapping"""
+    return text.translate(_RFC1459_LOWER)
+
+
+def normalize_mask(mask):
+    """Expands partial masks to nick!ident@host form.
+
+    "nick" becomes "nick!*@*", "ident@host" becomes "*!ident@host" and
+    "nick!ident" becomes "nick!ident@*".
+    """
+    if '!' not in mask and '@' not in mask:
+        return mask + '!*@*'
+    if '!' not in mask:
+        return '*!' + mask
+    if '@' not in mask:
+        return mask + '@*'
+    return mask
+
+
+def hostmask(user):
+    """nick!ident@host of a (nick, ident, host, ...) user"""
+    return '{}!{}@{}'.format(user[0] or '', user[1] or '', user[2] or '')
+
+
+def _compile(mask):
+    pattern = re.escape(mask).replace('\\*', '.*').replace('\\?', '.')
+    return re.compile(pattern + r'\Z', re.DOTALL)
+
+
+class _Node:
+    __slots__ = ('children', 'masks')
+
+    def __init__(self):
+        self.children = {}
+        self.masks = set()
+
+
+class HostmaskIndex:
+    """Answers "which of these wildcard masks match this user?"
+
+    Masks are indexed by the literal tail of their host part, after the
+    last wildcard, in a trie of reversed hosts, so "*!*@*.example.com"
+    sits under "moc.elpmaxe." and is only tested against users whose host
+    ends in ".example.com". Masks with a wildcard at the end of the host
+    fall back to an index on a literal nick, then a literal ident, and
+    only fully wild masks are tested against every user. Each candidate
+    is confirmed with its compiled pattern, so matching one user costs
+    roughly the length of its host plus the masks that actually share
+    its suffix, rather than the size of the whole list.
+
+    Each mask may carry a value, e.g. a reason or who set it.
+    """
+
+    def __init__(self, masks=()):
+        self.clear()
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __contains__(self, mask):
+        return irc_lower(normalize_mask(mask)) in self._masks
+
+    def __iter__(self):
+        return (entry[0] for entry in self._masks.values())
+
+    def _bucket(self, key):
+        """Returns the (container, key) a normalized mask is stored under"""
+        nick, _, rest = key.partition('!')
+        ident, _, host = rest.partition('@')
+        if not _WILDCARDS.search(host):
+            return self._exact_hosts, host
+        suffix = _WILDCARDS.split(host)[-1]
+        if suffix:
+            node = self._suffixes
+            for char in reversed(suffix):
+                node = node.children.setdefault(char, _Node())
+            return node.masks, None
+        if not _WILDCARDS.search(nick):
+            return self._nicks, nick
+        if not _WILDCARDS.search(ident):
+            return self._idents, ident
+        return self._wild, None
+
+    def add(self, mask, value=None):
+        """Adds mask, replacing the value if it is already indexed"""
+        mask = normalize_mask(mask)
+        key = irc_lower(mask)
+        if key not in self._masks:
+            container, bucket_key = self._bucket(key)
+            if bucket_key is None:
+                container.add(key)
+            else:
+                container.setdefault(bucket_key, set()).add(key)
+        self._masks[key] = (mask, _compile(key), value)
+
+    def remove(self, mask):
+        """Removes mask, returning False if it wasn't indexed"""
+        key = irc_lower(normalize_mask(mask))
+        if key not in self._masks:
+            return False
+        del self._masks[key]
+        container, bucket_key = self._bucket(key)
+        if bucket_key is None:
+            container.discard(key)
+        else:
+            keys = container[bucket_key]
+            keys.discard(key)
+            if not keys:
+                del container[bucket_key]
+        return True
+
+    def clear(self):
+        self._masks = {}
+        self._exact_hosts = {}
+        self._suffixes = _Node()
+        self._nicks = {}
+        self._idents = {}
+        self._wild = set()
+
+    def get(self, mask, default=None):
+        entry = self._masks.get(irc_lower(normalize_mask(mask)))
+        return entry[2] if entry is not None else default
+
+    def _candidates(self, nick, ident, host):
+        candidates = set(self._wild)
+        candidates.update(self._exact_hosts.get(host, ()))
+        candidates.update(self._nicks.get(nick, ()))
+        candidates.update(self._idents.get(ident, ()))
+        node = self._suffixes
+        for char in reversed(host):
+            node = node.children.get(char)
+            if node is None:
+                break
+            candidates.update(node.masks)
+        return candidates
+
+    def match(self, user):
+        """Returns [(mask, value), ...] for every mask matching user"""
+        if not self._masks:
+            return []
+        nick = irc_lower(user[0] or '')
+        ident = irc_lower(user[1] or '')
+        host = irc_lower(user[2] or '')
+        full = '{}!{}@{}'.format(nick, ident, host)
+        matched = []
+        for key in self._candidates(nick, ident, host):
+            mask, pattern, value = self._masks[key]
+            if pattern.match(full):
+                matched.append((mask, value))
+        return matched
+
+    def matches(self, user):
+        """True if any mask matches user"""
+        return bool(self.match(user))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from pancakesbot.hostmask import irc_lower
+
+# Not defined by circuits, servers send their ISUPPORT tokens with it
+RPL_ISUPPORT = 5
+
+# How a channel mode takes its parameter
+LIST = 'list'        # Always, e.g. b: ban mask
+PARAM = 'param'      # Always, e.g. k: key
+SET_PARAM = 'set'    # Only when set, e.g. l: limit
+FLAG = 'flag'        # Never, e.g. m
+PREFIX = 'prefix'    # Always a nick, e.g. o, v
+
+# RFC 1459 style defaults, until the server says otherwise
+DEFAULT_CHANMODES = ('beI', 'k', 'l', 'imnpst')
+DEFAULT_PREFIXES = (('q', '~'), ('a', '&'), ('o', '@'), ('h', '%'), ('v', '+'))
+DEFAULT_MAX_MODES = 3
+
+
+class ServerModes:
+    """Channel mode table, as advertised by the server in RPL_ISUPPORT.
+
+    Keeps the CHANMODES and PREFIX tokens as mode: kind tables, so any
+    number of modes in a MODE line can be split with their parameters in
+    a single pass, and the MODES limit of parameter modes per line. The
+    tables are kept apart, so neither token undoes the other whatever
+    order they come in.
+    """
+
+    def __init__(self):
+        self.chanmodes = {}
+        self.prefix_modes = frozenset()
+        self.prefixes = ()
+        self.max_modes = DEFAULT_MAX_MODES
+        self.set_chanmodes(DEFAULT_CHANMODES)
+        self.set_prefixes(DEFAULT_PREFIXES)
+
+    def set_chanmodes(self, groups):
+        """Sets the A,B,C,D mode groups of the CHANMODES token"""
+        self.chanmodes = {}
+        for kind, modes in zip((LIST, PARAM, SET_PARAM, FLAG), groups):
+            for mode in modes:
+                self.chanmodes[mode] = kind
+
+    def set_prefixes(self, prefixes):
+        """Sets the (mode, prefix) pairs of the PREFIX token, highest first"""
+        self.prefixes = tuple(prefixes)
+        self.prefix_modes = frozenset(mode for mode, prefix
+                                      in self.prefixes)
+
+    def isupport(self, tokens):
+        """Applies RPL_ISUPPORT tokens, returns True if PREFIX changed"""
+        prefixes_changed = False
+        for token in tokens:
+            name, _, value = token.partition('=')
+            if name == 'CHANMODES':
+                self.set_chanmodes(value.split(','))
+            elif name == 'PREFIX' and value.startswith('('):
+                modes, _, prefixes = value[1:].partition(')')
+                self.set_prefixes(zip(modes, prefixes))
+                prefixes_changed = True
+            elif name == 'MODES':
+                # MODES without a value means no limit
+                self.max_modes = int(value) if value else None
+        return prefixes_changed
+
+    def kind(self, mode):
+        if mode in self.prefix_modes:
+            return PREFIX
+        # Unknown modes are assumed to take no parameter
+        return self.chanmodes.get(mode, FLAG)
+
+    def is_prefix(self, mode):
+        return mode in self.prefix_modes
+
+    def parse(self, modes, params=()):
+        """Splits a mode string into [(adding, mode, param), ...]
+
+        "+ooov-b", ("a", "b", "c", "d", "*!*@x") gives
+        [(True, 'o', 'a'), (True, 'o', 'b'), (True, 'o', 'c'),
+         (True, 'v', 'd'), (False, 'b', '*!*@x')]. param is None for
+        modes without one, or if the server sent too few.
+        """
+        changes = []
+        params = iter(params)
+        adding = True
+        for mode in modes:
+            if mode == '+':
+                adding = True
+            elif mode == '-':
+                adding = False
+            else:
+                kind = self.kind(mode)
+                if kind == FLAG or (kind == SET_PARAM and not adding):
+                    param = None
+                else:
+                    param = next(params, None)
+                changes.append((adding, mode, param))
+        return changes
+
+
+class ModeBatcher:
+    """Collects channel mode changes to send packed into few MODE lines.
+
+    Changes are kept per channel in the order they were asked for. A
+    change to the same mode and parameter as an earlier pending one, such
+    as -o nick after +o nick, replaces it, since only the last would
+    stick anyway.
+    """
+
+    def __init__(self):
+        # irc_lower(channel): (channel, {(mode, lowered param): change})
+        self._pending = {}
+
+    def __len__(self):
+        return sum(len(changes) for channel, changes in
+                   self._pending.values())
+
+    def add(self, channel, mode, param=None):
+        """Queues a single change such as '+o', 'nick'"""
+        key = irc_lower(channel)
+        if key not in self._pending:
+            self._pending[key] = (channel, {})
+        changes = self._pending[key][1]
+        change = (mode[1:], irc_lower(param) if param is not None else None)
+        changes.pop(change, None)
+        changes[change] = (mode[0] == '+', mode[1:], param)
+
+    def __contains__(self, channel):
+        return irc_lower(channel) in self._pending
+
+    def flush(self, max_modes=None, channel=None):
+        """Returns [(channel, modes, params), ...] and clears the batch,
+        or only channel's part of it.
+
+        Each entry is one MODE line with at most max_modes changes, such
+        as ('#chan', '+ooo-v', ['a', 'b', 'c', 'd']).
+        """
+        if channel is None:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        else:
+            entry = self._pending.pop(irc_lower(channel), None)
+            pending = [entry] if entry is not None else []
+        lines = []
+        for channel, changes in pending:
+            changes = list(changes.values())
+            size = max_modes or len(changes)
+            for start in range(0, len(changes), size):
+                modes = []
+                params = []
+                sign = None
+                for adding, mode, param in changes[start:start + size]:
+                    if adding != sign:
+                        sign = adding
+                        modes.append('+' if adding else '-')
+                    modes.append(mode)
+                    if param is not None:
+                        params.append(param)
+                lines.append((channel, ''.join(modes), params))
+        return lines
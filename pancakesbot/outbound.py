@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from time import monotonic
+
+# Priority lanes, highest first. Queued lines always leave from the
+# highest lane that has any.
+PROTOCOL = 0     # Registration, PING/PONG, JOIN/PART, QUIT
+MODERATION = 1   # MODE, KICK, INVITE, TOPIC
+REPLY = 2        # Messages answering someone
+BULK = 3         # Long listings and the rest of multi-line output
+LANES = 4
+# Lanes whose lines may be dropped when the queue is full
+BOUNDED_LANES = (REPLY, BULK)
+
+# Overflow policies, what to do with a line that doesn't fit.
+# COLLAPSE drops it if the same line is already queued for its target,
+# and otherwise makes room like DROP_OLDEST.
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COLLAPSE = 'collapse-duplicates'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, COLLAPSE)
+
+COMMAND_PRIORITIES = {
+    'PASS': PROTOCOL,
+    'CAP': PROTOCOL,
+    'NICK': PROTOCOL,
+    'USER': PROTOCOL,
+    'PING': PROTOCOL,
+    'PONG': PROTOCOL,
+    'QUIT': PROTOCOL,
+    'JOIN': PROTOCOL,
+    'PART': PROTOCOL,
+    'WHO': PROTOCOL,
+    'MODE': MODERATION,
+    'KICK': MODERATION,
+    'INVITE': MODERATION,
+    'TOPIC': MODERATION,
+}
+
+
+# Longest line a server relays, including the prefix it adds and CRLF
+MAX_LINE = 512
+# Longest ident and host most servers allow, for when ours is unknown
+MAX_IDENT = 10
+MAX_HOST = 63
+
+
+def command_priority(message):
+    """Lane a circuits irc Message goes in, by its command"""
+    return COMMAND_PRIORITIES.get(message.command.upper(), REPLY)
+
+
+def text_room(nick, userhost, command, target):
+    """Bytes of text that fit in a command to target, once relayed.
+
+    The server prefixes what we send with our nick!ident@host, so
+    userhost is our (ident, host), or None to assume the longest.
+    """
+    if userhost is None:
+        userhost = ('x' * MAX_IDENT, 'x' * MAX_HOST)
+    overhead = ':{}!{}@{} {} {} :\r\n'.format(nick,
+                                              userhost[0],
+                                              userhost[1],
+                                              command,
+                                              target)
+    return MAX_LINE - len(overhead.encode('utf-8'))
+
+
+def split_text(text, limit):
+    """Splits text into pieces of at most limit UTF-8 bytes.
+
+    Pieces break at the last space that fits, which is dropped, or
+    else just before the first character that doesn't fit, so multibyte
+    characters are never cut in half. A single character longer than
+    limit makes a piece of its own. Raises ValueError if limit < 1.
+    """
+    if limit < 1:
+        raise ValueError("No room for text, limit {}".format(limit))
+    data = text.encode('utf-8')
+    if len(data) <= limit:
+        return [text]
+    pieces = []
+    while len(data) > limit:
+        cut = limit
+        # Back up to the first byte of the character that doesn't fit
+        while cut > 0 and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        space = data.rfind(b' ', 0, cut + 1)
+        if space > 0:
+            pieces.append(data[:space])
+            data = data[space + 1:]
+        else:
+            if cut == 0:
+                # Skip to the end of the first character instead
+                cut = 1
+                while cut < len(data) and data[cut] & 0xC0 == 0x80:
+                    cut += 1
+            pieces.append(data[:cut])
+            data = data[cut:]
+    if data:
+        pieces.append(data)
+    return [piece.decode('utf-8') for piece in pieces]
+
+
+def split_message(text, limit):
+    """split_text for PRIVMSG and NOTICE text, keeping CTCP framing.
+
+    The payload of a CTCP message such as "\x01ACTION waves\x01" is
+    split instead, in room left by the framing, and each piece framed
+    the same way, so every line is a whole CTCP message.
+    """
+    if (len(text) > 2 and text[0] == '\x01' and text[-1] == '\x01' and
+            ' ' in text and len(text.encode('utf-8')) > limit):
+        command, _, payload = text[1:-1].partition(' ')
+        head = '\x01' + command + ' '
+        framing = len(head.encode('utf-8')) + 1
+        return [head + piece + '\x01'
+                for piece in split_text(payload, limit - framing)]
+    return split_text(text, limit)
+
+
+class _Lane:
+    __slots__ = ('queues', 'turns')
+
+    def __init__(self):
+        # target: deque of (queued at, item)
+        self.queues = {}
+        # Targets with queued items, in the order they get their turn
+        self.turns = deque()
+
+
+class SendScheduler:
+    """Paces outbound lines with a token bucket, round-robin per target.
+
+    Up to burst lines go out back to back, after which lines are released
+    at rate per second, the same way IRC servers meter their clients.
+    Lines wait in priority lanes, and within a lane each target has its
+    own deque and targets take turns, so one long reply to a channel
+    doesn't hold up every other channel behind it, and nothing in a lower
+    lane goes out while a higher one has lines waiting.
+
+    Reply and bulk lines are bounded, to max_target per target and lane
+    and max_total overall, and overflow says which line gives way when
+    they are full. Protocol and moderation lines are never dropped.
+
+    While paused, only protocol lines go out and the rest wait, up to ttl
+    seconds after which they are dropped as stale instead of sent.
+    """
+
+    def __init__(self, burst=4, rate=1.0, max_target=50, max_total=500,
+                 overflow=DROP_OLDEST, ttl=None, clock=monotonic):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy {!r}".format(overflow))
+        self.burst = burst
+        self.rate = rate
+        self.max_target = max_target
+        self.max_total = max_total
+        self.overflow = overflow
+        self.ttl = ttl
+        self.clock = clock
+        self._tokens = float(burst)
+        self._refilled = clock()
+        self._lanes = [_Lane() for lane in range(LANES)]
+        # Lanes below this one may send
+        self._open_lanes = LANES
+        self.depth = 0
+        # Lines queued in BOUNDED_LANES
+        self.bounded = 0
+        self.sent = 0
+        self.dropped = 0
+        self.collapsed = 0
+        self.expired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return self.depth
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def push(self, target, item, priority=REPLY, merge=None):
+        """Queues item for target, returns False if it was dropped.
+
+        merge(queued, item) may combine item with the last item still
+        queued for target in the same lane, returning the combined item
+        or None to queue item on its own.
+        """
+        lane = self._lanes[priority]
+        queue = lane.queues.get(target)
+        if queue is not None and merge is not None:
+            queued, last = queue[-1]
+            merged = merge(last, item)
+            if merged is not None:
+                queue[-1] = (queued, merged)
+                return True
+        if priority in BOUNDED_LANES:
+            if not self._make_room(lane, target, item):
+                self.dropped += 1
+                return False
+            self.bounded += 1
+            queue = lane.queues.get(target)
+        if queue is None:
+            queue = lane.queues[target] = deque()
+            lane.turns.append(target)
+        queue.append((self.clock(), item))
+        self.depth += 1
+        return True
+
+    def _make_room(self, lane, target, item):
+        """Applies the overflow policy, returns False to drop item"""
+        queue = lane.queues.get(target, ())
+        target_full = len(queue) >= self.max_target
+        if not target_full and self.bounded < self.max_total:
+            return True
+        if self.overflow == DROP_NEWEST:
+            return False
+        if self.overflow == COLLAPSE:
+            if any(queued == item for _, queued in queue):
+                self.collapsed += 1
+                return False
+        if target_full:
+            self._drop_oldest(lane, target)
+        else:
+            self._drop_oldest(*self._longest())
+        return True
+
+    def _longest(self):
+        """(lane, target) of the longest bounded queue, bulk lane first"""
+        for priority in reversed(BOUNDED_LANES):
+            lane = self._lanes[priority]
+            if lane.queues:
+                return lane, max(lane.queues,
+                                 key=lambda target: len(lane.queues[target]))
+
+    def _drop_oldest(self, lane, target):
+        queue = lane.queues[target]
+        queue.popleft()
+        if not queue:
+            del lane.queues[target]
+            lane.turns.remove(target)
+        self.depth -= 1
+        self.bounded -= 1
+        self.dropped += 1
+
+    def queued(self, target=None):
+        """Reply and bulk lines waiting for target, or for everyone"""
+        if target is None:
+            return self.bounded
+        return sum(len(self._lanes[priority].queues.get(target, ()))
+                   for priority in BOUNDED_LANES)
+
+    def congested(self, target=None, high_water=0.75):
+        """True once target's, or the whole, queue is mostly full.
+
+        Lets plugins hold off producing output that would only be
+        dropped or arrive long after it was asked for.
+        """
+        if self.bounded >= self.max_total * high_water:
+            return True
+        if target is None:
+            return False
+        return any(len(self._lanes[priority].queues.get(target, ())) >=
+                   self.max_target * high_water
+                   for priority in BOUNDED_LANES)
+
+    @property
+    def paused(self):
+        return self._open_lanes <= PROTOCOL + 1
+
+    def pause(self):
+        """Holds everything but protocol lines, e.g. while reconnecting"""
+        self._open_lanes = PROTOCOL + 1
+
+    def resume(self):
+        self._open_lanes = LANES
+
+    def reset(self):
+        """Fills the bucket back up, for a fresh connection"""
+        self._tokens = float(self.burst)
+        self._refilled = self.clock()
+
+    def clear(self, priority):
+        """Drops every line in a lane, returns how many there were"""
+        lane = self._lanes[priority]
+        count = sum(map(len, lane.queues.values()))
+        lane.queues.clear()
+        lane.turns.clear()
+        self.depth -= count
+        if priority in BOUNDED_LANES:
+            self.bounded -= count
+        return count
+
+    def _next(self, now):
+        """Pops the next line from the open lanes, skipping stale ones"""
+        for priority in range(self._open_lanes):
+            lane = self._lanes[priority]
+            while lane.turns:
+                target = lane.turns.popleft()
+                queue = lane.queues[target]
+                queued, item = queue.popleft()
+                if queue:
+                    lane.turns.append(target)
+                else:
+                    del lane.queues[target]
+                self.depth -= 1
+                if priority in BOUNDED_LANES:
+                    self.bounded -= 1
+                if (self.ttl is not None and priority != PROTOCOL and
+                        now - queued > self.ttl):
+                    self.expired += 1
+                    continue
+                return queued, item
+        return None
+
+    def pop_due(self):
+        """Returns the items the bucket allows right now, in send order"""
+        now = self.clock()
+        self._refill(now)
+        due = []
+        while self._tokens >= 1:
+            line = self._next(now)
+            if line is None:
+                break
+            queued, item = line
+            self._tokens -= 1
+            self.sent += 1
+            wait = now - queued
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            due.append(item)
+        return due
+
+    def delay(self):
+        """Seconds until the next line may go out, None if nothing can"""
+        if not any(self._lanes[priority].turns
+                   for priority in range(self._open_lanes)):
+            return None
+        self._refill(self.clock())
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def stats(self):
+        """Queue depth and wait time metrics"""
+        oldest = min((queue[0][0]
+                      for lane in self._lanes
+                      for queue in lane.queues.values()),
+                     default=None)
+        return {
+            'queued': self.depth,
+            'lanes': [sum(map(len, lane.queues.values()))
+                      for lane in self._lanes],
+            'targets': len(set().union(*(lane.queues
+                                         for lane in self._lanes))),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'collapsed': self.collapsed,
+            'expired': self.expired,
+            'paused': self.paused,
+            'wait_avg': self.wait_total / self.sent if self.sent else 0.0,
+            'wait_max': self.wait_max,
+            'oldest': self.clock() - oldest if oldest is not None else 0.0,
+        }
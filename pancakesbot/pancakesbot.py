@@ -4,22 +4,43 @@
 import logging
 import os
 import sys
-from time import time
+from time import time, perf_counter
 from signal import SIGINT, SIGTERM
 
 from circuits import Component, handler, Timer, Event
+from circuits.net.events import write
 from circuits.net.sockets import TCPClient, connect
 from circuits.protocols.irc import (
     request, Message,
-    IRC, NICK, USER, JOIN, PRIVMSG, QUIT, WHO,
-    RPL_ENDOFMOTD, RPL_WHOREPLY,
+    IRC, MODE, NICK, USER, JOIN, QUIT, WHO,
+    RPL_BANLIST, RPL_ENDOFMOTD, RPL_ENDOFWHO, RPL_WHOREPLY,
     ERR_NICKNAMEINUSE, ERR_NOMOTD
 )
 
 import pancakesbot.events as events
-from pancakesbot.users import UserManager
+from pancakesbot.channels import ChannelRoster
+from pancakesbot.hostmask import HostmaskIndex, irc_lower
+from pancakesbot.modes import RPL_ISUPPORT, ModeBatcher, ServerModes
+from pancakesbot.outbound import (
+    MODERATION, PROTOCOL, REPLY, SendScheduler, command_priority,
+    split_message, text_room
+)
+from pancakesbot.storage import open_store
+from pancakesbot.users import User, UserManager
 from pancakesbot.plugins import PluginManager
 
+# Modes with their own plugin event: (event, log message)
+MODE_EVENTS = {
+    '+b': (events.on_ban, "BAN: {} banned {} from {}"),
+    '-b': (events.on_unban, "UNBAN: {} unbanned {} from {}"),
+    '+v': (events.on_voice, "VOICE: {} gave voice to {} in {}"),
+    '-v': (events.on_devoice, "DEVOICE: {} removed voice from {} in {}"),
+    '+o': (events.on_op, "OP: {} gave operator to {} in {}"),
+    '-o': (events.on_deop, "DEOP: {} removed operator from {} in {}"),
+    '+q': (events.on_owner, "OWNER: {} gave owner to {} in {}"),
+    '-q': (events.on_deowner, "DEOWNER: {} removed owner from {} in {}"),
+}
+
 
 class PancakesBot(Component):
 
@@ -35,7 +56,28 @@ class PancakesBot(Component):
             'plugins': ['admin'],
             'plugins_path': 'plugins',
             'command_prefix': '~',
-            'storage_path': 'storage'
+            'admin_prefix': '~',
+            'storage_path': 'storage',
+            'user_cache_size': 4096,
+            'user_cache_ttl': 600.0,
+            'user_flush_interval': 5.0,
+            'user_flush_size': 256,
+            'user_db_readers': 2,
+            'user_store': 'sqlite',
+            'user_snapshot_interval': 60.0,
+            'ignores': [],
+            'send_burst': 4,
+            'send_rate': 1.0,
+            'send_queue_target_limit': 50,
+            'send_queue_limit': 500,
+            'send_overflow': 'drop-oldest',
+            'send_ttl': 300.0,
+            'coalesce_separator': ' | ',
+            'mode_batch_window': 0.25,
+            'command_threads': 4,
+            'command_queue_limit': 16,
+            'command_timeout': 30.0,
+            'hosted_plugins': []
         }
         self.__dict__.update(prop_defaults)
         # Overwrite defaults with kwargs
@@ -43,16 +85,50 @@ class PancakesBot(Component):
             self.__dict__.update(kwargs)
 
         self.terminate = False
+        # Between connected and disconnected
+        self.connected = False
         self.storage_path = os.path.abspath(self.storage_path)
 
         # Add a logger
         self.logger = logging.getLogger(__name__)
 
-        # Message Queue used by plugins, as to avoid kicks for flooding.
-        self.msg_queue = []
-        # Global mesasge queue timer, only activated when there are messages
-        # to process.
+        # Every outbound command is queued here, by priority, as to avoid
+        # kicks for flooding.
+        self.send_queue = SendScheduler(
+            self.send_burst,
+            self.send_rate,
+            max_target=self.send_queue_target_limit,
+            max_total=self.send_queue_limit,
+            overflow=self.send_overflow,
+            ttl=self.send_ttl)
+        # Only registration goes out until we're signed in and rejoined
+        self.send_queue.pause()
+        # One-shot timer for when the next queued message may go out, only
+        # set while there are messages to process.
         self.queue_timer = None
+        # True while a process_queue event is on its way
+        self.queue_scheduled = False
+        # Our (ident, host) as the server sees it, once we've joined
+        self.userhost = None
+
+        # Messages from users matching these masks never reach plugins
+        self.ignore_list = HostmaskIndex(self.ignores)
+        # Ban masks per channel, from the ban list and +b/-b modes
+        self.channel_bans = {}
+
+        # WHO replies are collected per channel until RPL_ENDOFWHO, then
+        # looked up off the event loop and ingested in one go. Keeps
+        # (start time, users) while pending and the last sync duration in
+        # seconds per channel once done.
+        self.who_pending = {}
+        self.who_sync_times = {}
+        # Channel modes and limits from RPL_ISUPPORT
+        self.server_modes = ServerModes()
+        # Mode changes from plugins, sent together when the timer fires
+        self.mode_batch = ModeBatcher()
+        self.mode_timer = None
+        # Who is in each of our channels, with ids and prefix modes
+        self.roster = ChannelRoster(self.server_modes.prefixes)
 
         # Add TCPClient and IRC to the system.
         TCPClient(channel=self.channel).register(self)
@@ -60,13 +136,20 @@ class PancakesBot(Component):
 
         # Creates an instance of UserManager
         self.logger.debug("Initializing user manager.")
-        user_db_file = os.path.join(
-            self.storage_path,
-            'users-{}.db'.format(self.network)
-        )
         if not os.path.exists(self.storage_path):
             os.makedirs(self.storage_path)
-        self.user_mngr = UserManager(self, user_db_file)
+        user_store = open_store(
+            self.user_store,
+            os.path.join(self.storage_path,
+                         'users-{}'.format(self.network)),
+            readers=self.user_db_readers,
+            snapshot_interval=self.user_snapshot_interval)
+        self.user_mngr = UserManager(self,
+                                     user_store,
+                                     cache_size=self.user_cache_size,
+                                     cache_ttl=self.user_cache_ttl,
+                                     flush_interval=self.user_flush_interval,
+                                     flush_size=self.user_flush_size)
         self.user_mngr.register(self)
 
         # Add plugins directory to path
@@ -78,7 +161,8 @@ class PancakesBot(Component):
         # Keeps track of plugins and commands
         self.plugin_mngr = PluginManager(self,
                                          self.command_prefix,
-                                         os.path.basename(self.plugins_path)
+                                         os.path.basename(self.plugins_path),
+                                         self.admin_prefix
                                          ).register(self)
         for plugin in self.plugins:
             self.plugin_mngr.load(plugin)
@@ -86,25 +170,155 @@ class PancakesBot(Component):
         # Send Keepalive PING every 5 minutes
         Timer(300.0, Event.create("keepalive"), persist=True).register(self)
 
-    def enqueue_msg(self, target, message):
-        if self.queue_timer:
-            self.msg_queue.append((target, message))
+    def enqueue_msg(self, target, message, priority=REPLY, coalesce=False):
+        self._send(Message("PRIVMSG", target, message), priority, coalesce)
+
+    @handler("request", priority=1.0)
+    def _on_request(self, event, message):
+        # Hold back IRC's own request handler, it writes immediately
+        event.stop()
+        self._send(message, command_priority(message))
+
+    def _send(self, message, priority, coalesce=False):
+        """Queues message, split to fit a line once the server relays it.
+
+        Queued items are (encoded line, text) pairs, where text is the
+        (command, target, text) of lines allowed to coalesce, or None.
+        Those merge into the line queued just before them for the same
+        target, when that one allows it too and the result still fits.
+        """
+        # Batched modes for a channel go out before anything else sent
+        # there, so a ban isn't overtaken by the kick that follows it
+        if self.mode_timer is not None and message.args:
+            self.flush_modes(message.args[0])
+        if message.command in ("PRIVMSG", "NOTICE") and len(message.args) == 2:
+            target, text = message.args
+            try:
+                pieces = split_message(text, self._text_room(message.command,
+                                                             target))
+            except ValueError:
+                # Target too long to leave any room, the server truncates
+                self.logger.warning("QUEUE: No room for text to {}."
+                                    .format(target))
+                pieces = [text]
+            if len(pieces) > 1:
+                messages = [Message(message.command, target, piece)
+                            for piece in pieces]
+            else:
+                messages = [message]
+            for message in messages:
+                if coalesce:
+                    text = (message.command, target, message.args[1])
+                else:
+                    text = None
+                if not self.send_queue.push(target,
+                                            (bytes(message), text),
+                                            priority,
+                                            self._coalesce):
+                    self.logger.debug("QUEUE: Dropped {!r}, queue full."
+                                      .format(message))
         else:
-            self.fire(PRIVMSG(target, message))
-            self.queue_timer = Timer(1.0,
-                                     Event.create("process_queue"),
-                                     persist=True).register(self)
+            self.send_queue.push(message.args[0] if message.args else None,
+                                 (bytes(message), None),
+                                 priority)
+        self._schedule_queue()
+
+    def _text_room(self, command, target):
+        return text_room(self.nick, self.userhost, command, target)
+
+    def _coalesce(self, queued, item):
+        last, text = queued[1], item[1]
+        if last is None or text is None or last[0] != text[0]:
+            return None
+        command, target = text[:2]
+        text = last[2] + self.coalesce_separator + text[2]
+        if len(text.encode('utf-8')) > self._text_room(command, target):
+            return None
+        return (bytes(Message(command, target, text)), (command, target, text))
+
+    def queue_mode(self, channel, mode, param=None):
+        self.mode_batch.add(channel, mode, param)
+        if self.mode_timer is None:
+            self.mode_timer = Timer(self.mode_batch_window,
+                                    Event.create("flush_modes"),
+                                    self.channel).register(self)
+
+    def flush_modes(self, channel=None):
+        """Queues the batched mode changes, or only those for channel"""
+        lines = self.mode_batch.flush(self.server_modes.max_modes, channel)
+        if channel is None:
+            # The timer fired
+            self.mode_timer = None
+        elif self.mode_timer is not None and not self.mode_batch:
+            self.mode_timer.unregister()
+            self.mode_timer = None
+        for channel, modes, params in lines:
+            self._send(Message("MODE", channel, modes, *params), MODERATION)
+
+    def resume_queue(self):
+        self.logger.info("QUEUE: Resuming, {} lines waiting."
+                         .format(len(self.send_queue)))
+        self.send_queue.resume()
+        self._schedule_queue()
+
+    def _schedule_queue(self):
+        """Processes the queue once the events fired so far are handled.
+
+        Everything queued in the meantime then goes out in the same write,
+        unless the timer is already waiting for the next token.
+        """
+        if self.queue_timer is None and not self.queue_scheduled:
+            self.queue_scheduled = True
+            self.fire(Event.create("process_queue"))
 
     def process_queue(self):
-        if self.msg_queue:
-            msg = self.msg_queue[0]
-            self.fire(PRIVMSG(msg[0], msg[1]))
-            self.msg_queue.pop(0)
-        if not self.msg_queue:
-            self.queue_timer.unregister()
-            self.queue_timer = None
+        self.queue_scheduled = False
+        self.queue_timer = None
+        due = self.send_queue.pop_due()
+        if due:
+            # Lines are encoded as they're queued, so a burst is one write
+            self.fire(write(b''.join(data for data, text in due)))
+        delay = self.send_queue.delay()
+        if delay is not None:
+            self.queue_timer = Timer(delay,
+                                     Event.create("process_queue"),
+                                     self.channel).register(self)
+
+    def is_ignored(self, user):
+        """True if user matches a mask in the ignore list"""
+        return bool(self.ignore_list) and self.ignore_list.matches(user)
+
+    def banned_masks(self, channel, user):
+        """Ban masks set in channel that match user"""
+        bans = self.channel_bans.get(irc_lower(channel))
+        if not bans:
+            return []
+        return [mask for mask, setter in bans.match(user)]
+
+    def _bans(self, channel):
+        channel = irc_lower(channel)
+        if channel not in self.channel_bans:
+            self.channel_bans[channel] = HostmaskIndex()
+        return self.channel_bans[channel]
+
+    def get_user(self, nick):
+        """Full User for nick.
+
+        Nicks sharing a channel with us come from the roster, anything
+        else falls back to the user DB, then to User(nick).
+        """
+        user = self.roster.user(nick)
+        if user is None:
+            user = self.user_mngr.get_full_user(nick=nick)
+        if user is None:
+            user = User(nick)
+        return user
 
     def keepalive(self):
+        # Nothing to keep alive, and the PING would only be queued for
+        # a dead socket
+        if not self.connected:
+            return
         timestamp = int(time() * 1000)
         self.logger.debug("PING: {}".format(timestamp))
         self.fire(request(Message("PING", "LAG{0}".format(timestamp))))
@@ -122,17 +336,19 @@ class PancakesBot(Component):
 
     @handler("privmsg")
     def _on_text(self, user, target, message):
-        user += (self.user_mngr.get_user_id(user), )
+        if self.is_ignored(user):
+            return
+        user = self.user_mngr.lazy_user(user)
         if (message.startswith("\x01ACTION ")) and (message[-1] == '\x01'):
             message = message[7:]
             self.logger.debug("ACTION: {}({})@{}: {}".format(user[0],
-                                                             user[3],
+                                                             user.known_id,
                                                              target,
                                                              message))
             self.fire(events.on_action(user, target, message), 'plugins')
         else:
             self.logger.debug("MSG: {}({})@{}: {}".format(user[0],
-                                                          user[3],
+                                                          user.known_id,
                                                           target,
                                                           message))
             self.fire(events.on_text(user, target, message), 'plugins')
@@ -147,6 +363,8 @@ class PancakesBot(Component):
     @handler("connected")
     def _on_connected(self, network, port):
         self.logger.info("Connected. Signing in as {0.nick}".format(self))
+        self.connected = True
+        self.send_queue.reset()
         self.fire(NICK(self.nick))
         self.fire(USER("pancakes", "pancakes", network, "robot"))
         self.fire(events.on_logon(network, port), 'plugins')
@@ -154,8 +372,17 @@ class PancakesBot(Component):
     @handler("disconnected")
     def _on_disconnected(self):
         self.logger.info("Disconnected.")
+        self.connected = False
+        self.roster.clear()
+        # Protocol lines belong to the old connection, the rest waits for
+        # the next one
+        self.send_queue.pause()
+        self.send_queue.clear(PROTOCOL)
+        self.logger.info("QUEUE: Holding {} lines until reconnected."
+                         .format(len(self.send_queue)))
         self.fire(events.on_disconnect(), 'plugins')
         if self.terminate:
+            self.user_mngr.close()
             raise SystemExit(0)
         else:
             self.logger.info("Reconnecting.")
@@ -167,19 +394,27 @@ class PancakesBot(Component):
         self.terminate = True
         self.fire(events.on_exit(), 'plugins')
         self.logger.info("Terminating.")
+        self.plugin_mngr.shutdown()
+        self.user_mngr.close()
         raise SystemExit(0)
 
     @handler("join")
     def _on_join(self, user, channel):
         # Send a who for channel on join
         if user[0] == self.nick:
+            self.userhost = (user[1], user[2])
+            self.who_pending[irc_lower(channel)] = (perf_counter(), [])
             self.fire(WHO(channel))
+            self._bans(channel).clear()
+            self.fire(MODE(channel, "b"))
+            self.roster.drop_channel(channel)
 
-        user += (self.user_mngr.get_user_id(user), )
+        user = self.user_mngr.lazy_user(user)
+        self.roster.add(channel, user)
         self.fire(events.on_join(user, channel), 'plugins')
         self.logger.info("JOIN: {} ({}) to {}"
                          .format(user[0],
-                                 user[3],
+                                 user.known_id,
                                  channel))
 
     @handler("part")
@@ -188,11 +423,16 @@ class PancakesBot(Component):
             message = args[0]
         else:
             message = ""
-        user += (self.user_mngr.get_user_id(user), )
+        if user[0] == self.nick:
+            self.channel_bans.pop(irc_lower(channel), None)
+            self.roster.drop_channel(channel)
+        else:
+            self.roster.remove(channel, user[0])
+        user = self.user_mngr.lazy_user(user)
         self.fire(events.on_part(user, channel, message), 'plugins')
         self.logger.debug("PART: {} ({}) from {} ({})"
                           .format(user[0],
-                                  user[3],
+                                  user.known_id,
                                   channel,
                                   message))
 
@@ -202,15 +442,18 @@ class PancakesBot(Component):
             message = args[0]
         else:
             message = ""
-        user += (self.user_mngr.get_user_id(user), )
+        self.roster.quit(user[0])
+        user = self.user_mngr.lazy_user(user)
         self.fire(events.on_quit(user, message), 'plugins')
         self.logger.debug("QUIT: {} ({})".format(user[0],
-                                                 user[3],
+                                                 user.known_id,
                                                  message))
 
     @handler("notice")
     def _on_notice(self, user, target, message):
-        user += (self.user_mngr.get_user_id(user), )
+        if self.is_ignored(user):
+            return
+        user = self.user_mngr.lazy_user(user)
         self.fire(events.on_notice(user, target, message), 'plugins')
         self.logger.debug("NOTICE: {}@{}: {}"
                           .format(user[0],
@@ -219,100 +462,100 @@ class PancakesBot(Component):
 
     @handler("invite")
     def _on_invite(self, nickname, channel):
-        user = self.user_mngr.get_full_user(nick=nickname)
+        user = self.get_user(nickname)
         self.fire(events.on_invite(user, channel), 'plugins')
         self.logger.info("INVITE: {} ({}) invited us to {}."
                          .format(user[0],
-                                 user[3],
+                                 user.known_id,
                                  channel))
 
     @handler("kick")
     def _on_kick(self, user, channel, target, message):
-        user += (self.user_mngr.get_user_id(user), )
-        target = self.user_mngr.get_full_user(nick=target)
+        user = self.user_mngr.lazy_user(user)
+        t_nick = target
+        target = self.get_user(t_nick)
+        if t_nick == self.nick:
+            self.channel_bans.pop(irc_lower(channel), None)
+            self.roster.drop_channel(channel)
+        else:
+            self.roster.remove(channel, t_nick)
         self.fire(events.on_kick(user, target, channel, message), 'plugins')
         self.logger.debug("KICK: {} ({}) kicked {} ({}) from {} ({})"
                           .format(user[0],
-                                  user[3],
+                                  user.known_id,
                                   target[0],
-                                  target[3],
+                                  target.known_id,
                                   channel,
                                   message))
 
     @handler("mode")
-    def _on_mode(self, user, target, mode, *args):
-        if mode == "+b":
-            user += (self.user_mngr.get_user_id(user), )
-            self.fire(events.on_ban(user, args[0], target), 'plugins')
-            self.logger.debug("BAN: {} banned {} from {}".format(user[0],
-                                                                 args[0],
-                                                                 target))
-        elif mode == "-b":
-            user += (self.user_mngr.get_user_id(user), )
-            self.fire(events.on_unban(user, args[0], target), 'plugins')
-            self.logger.debug("UNBAN: {} unbanned {} from {}".format(user[0],
-                                                                     args[0],
-                                                                     target))
-        elif mode == "+v":
-            user += (self.user_mngr.get_user_id(user), )
-            t_user = self.user_mngr.get_full_user(nick=args[0])
-            self.fire(events.on_voice(user, t_user, target), 'plugins')
-            self.logger.debug("VOICE: {} gave voice "
-                              "to {} in {}".format(user[0],
-                                                   t_user[0],
-                                                   target))
-        elif mode == "-v":
-            user += (self.user_mngr.get_user_id(user), )
-            t_user = self.user_mngr.get_full_user(nick=args[0])
-            self.fire(events.on_devoice(user, t_user, target), 'plugins')
-            self.logger.debug("DEVOICE: {} removed voice "
-                              "from {} in {}".format(user[0],
-                                                     t_user[0],
-                                                     target))
-        elif mode == "+o":
-            user += (self.user_mngr.get_user_id(user), )
-            t_user = self.user_mngr.get_full_user(nick=args[0])
-            self.fire(events.on_op(user, t_user, target), 'plugins')
-            self.logger.debug("OP: {} gave operator "
-                              "to {} in {}".format(user[0],
-                                                   t_user[0],
-                                                   target))
-        elif mode == "-o":
-            user += (self.user_mngr.get_user_id(user), )
-            t_user = self.user_mngr.get_full_user(nick=args[0])
-            self.fire(events.on_deop(user, t_user, target), 'plugins')
-            self.logger.debug("DEOP: {} removed operator "
-                              "from {} in {}".format(user[0],
-                                                     t_user[0],
-                                                     target))
-        elif mode == "+q":
-            user += (self.user_mngr.get_user_id(user), )
-            t_user = self.user_mngr.get_full_user(nick=args[0])
-            self.fire(events.on_owner(user, t_user, target), 'plugins')
-            self.logger.debug("OWNER: {} gave owner "
-                              "to {} in {}".format(user[0],
-                                                   t_user[0],
-                                                   target))
-        elif mode == "-q":
-            user += (self.user_mngr.get_user_id(user), )
-            t_user = self.user_mngr.get_full_user(nick=args[0])
-            self.fire(events.on_deowner(user, t_user, target), 'plugins')
-            self.logger.debug("DEOWNER: {} removed owner "
-                              "from {} in {}".format(user[0],
-                                                     t_user[0],
-                                                     target))
-        elif target.startswith('#'):
-            user += (self.user_mngr.get_user_id(user), )
-            self.fire(events.on_mode(user, mode, target), 'plugins')
-            self.logger.debug("MODE: {} set {} in {} ({})".format(user[0],
-                                                                  mode,
-                                                                  target,
-                                                                  args))
+    def _on_mode(self, user, target, modes, *args):
+        if not target.startswith('#'):
+            self.logger.debug("UMODE: {} set {} on {}".format(user[0],
+                                                              modes,
+                                                              target))
+            return
+        user = self.user_mngr.lazy_user(user)
+        # Resolve every target once, then dispatch the whole line
+        changes = []
+        t_users = {}
+        for adding, mode, param in self.server_modes.parse(modes, args):
+            if param is not None and self.server_modes.is_prefix(mode):
+                if param not in t_users:
+                    t_users[param] = self.get_user(param)
+                self.roster.set_mode(target, param, mode, adding)
+                param = t_users[param]
+            elif param is not None and mode == 'b':
+                if adding:
+                    self._bans(target).add(param, user[0])
+                else:
+                    self._bans(target).remove(param)
+            changes.append((('+' if adding else '-') + mode, param))
+
+        for mode, param in changes:
+            if mode in MODE_EVENTS and param is not None:
+                event, message = MODE_EVENTS[mode]
+                self.fire(event(user, param, target), 'plugins')
+                self.logger.debug(message.format(
+                    user[0],
+                    param.nick if isinstance(param, User) else param,
+                    target))
+            else:
+                self.fire(events.on_mode(user, mode, target), 'plugins')
+                self.logger.debug("MODE: {} set {} in {} ({})"
+                                  .format(user[0], mode, target, param))
+        self.fire(events.on_modes(user, target, changes), 'plugins')
 
     @handler("nick")
     def _on_nick(self, user, new_nick):
-        self.user_mngr.changed_nick(user, new_nick)
-        user += (self.user_mngr.get_user_id(user), )
+        # Renamed right away, so what follows from new_nick finds the user
+        current = self.roster.user(user[0])
+        if current is not None:
+            self.roster.rename(user[0], current.renamed(new_nick))
+        # The user DB is brought up to date once its lookups are done, so
+        # they don't hold up the messages that follow
+        found = self.user_mngr.lookup_users([user], [new_nick])
+        found.add_done_callback(
+            lambda found: self.fire(events.nick_found(user, new_nick, found)))
+
+    @handler("nick_found")
+    def _on_nick_found(self, user, new_nick, found):
+        try:
+            found = found.result()
+        except Exception as e:
+            self.logger.error("NICK: Failed to look up {}: {}"
+                              .format(user[0], e))
+            return
+        # The id is resolved before renaming, so the old tuple doesn't
+        # rewrite last_nick back to the previous nick.
+        user_id = self.user_mngr.ingest_users([user], found)[0]
+        self.user_mngr.changed_nick(user, new_nick, user_id, found)
+        user = User(user[0], user[1], user[2], user_id)
+        # Unless the nick has moved on in the meantime
+        current = self.roster.user(new_nick)
+        if (current is not None and
+                (current.ident, current.host) == (user.ident, user.host)):
+            self.roster.rename(new_nick, user.renamed(new_nick))
         self.fire(events.on_nick(user, new_nick), 'plugins')
         self.logger.debug("NICK: {} ({}) changed nick to {}"
                           .format(user[0],
@@ -321,10 +564,10 @@ class PancakesBot(Component):
 
     @handler("topic")
     def _on_topic(self, user, channel, topic):
-        user += (self.user_mngr.get_user_id(user), )
+        user = self.user_mngr.lazy_user(user)
         self.logger.debug("TOPIC: {} ({}) changed topic of {} to \"{}\""
                           .format(user[0],
-                                  user[3],
+                                  user.known_id,
                                   channel,
                                   topic))
 
@@ -338,14 +581,62 @@ class PancakesBot(Component):
             self.nick = newnick
             self.fire(NICK(newnick))
         if numeric == RPL_WHOREPLY:
-            print(args)
-            user = (args[5], args[2], args[3])
-            user += (self.user_mngr.get_user_id(user), )
-            print(user)
+            # Only replies to our own channel WHOs are collected, not
+            # those for a WHO a plugin sent for a nick or mask
+            pending = self.who_pending.get(irc_lower(args[1]))
+            if pending is not None:
+                # me, channel, ident, host, server, nick, flags, hops name
+                pending[1].append(((args[5], args[2], args[3]), args[6]))
+        elif numeric == RPL_ENDOFWHO:
+            # me, mask, "End of WHO list"
+            if irc_lower(args[1]) in self.who_pending:
+                self._sync_who(args[1])
+        elif numeric == RPL_ISUPPORT:
+            # me, token, ..., "are supported by this server"
+            if self.server_modes.isupport(args[1:-1]):
+                self.roster.set_prefixes(self.server_modes.prefixes)
+        elif numeric == RPL_BANLIST:
+            # me, channel, mask[, setter, time]
+            setter = args[3] if len(args) > 3 else None
+            self._bans(args[1]).add(args[2], setter)
         elif numeric in (RPL_ENDOFMOTD, ERR_NOMOTD):
             self.fire(events.on_connect(self.network, self.port), 'plugins')
             for chan in self.channels:
                 self.fire(JOIN(chan))
+            # Fired after the JOINs, so they are queued ahead of what waited
+            self.fire(Event.create("resume_queue"))
+
+    def _sync_who(self, channel):
+        started, users = self.who_pending.pop(irc_lower(channel))
+        found = self.user_mngr.lookup_users([user for user, flags in users])
+        found.add_done_callback(
+            lambda found: self.fire(events.who_found(channel, started,
+                                                     users, found)))
+
+    @handler("who_found")
+    def _on_who_found(self, channel, started, users, found):
+        try:
+            found = found.result()
+        except Exception as e:
+            self.logger.error("WHO: Failed to look up users in {}: {}"
+                              .format(channel, e))
+            return
+        ingest_started = perf_counter()
+        ids = self.user_mngr.ingest_users([user for user, flags in users],
+                                          found)
+        # Unless we left the channel in the meantime
+        if self.roster.is_on(channel, self.nick):
+            for (user, flags), user_id in zip(users, ids):
+                self.roster.who_reply(channel, User(*user, id=user_id),
+                                      flags)
+        finished = perf_counter()
+        self.who_sync_times[irc_lower(channel)] = finished - started
+        self.logger.info("WHO: Synced {} users in {} in {:.3f}s "
+                         "({:.3f}s resolving ids)."
+                         .format(len(users),
+                                 channel,
+                                 finished - started,
+                                 finished - ingest_started))
 
     # Used to test handlers to determine arguments
     @handler("test")
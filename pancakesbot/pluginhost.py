@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import multiprocessing
+import pickle
+import threading
+from itertools import count
+from importlib import import_module
+from inspect import getdoc, getmembers, isclass
+
+from circuits import Component, Event, Timer, handler
+
+from pancakesbot.baseplugin import BasePlugin
+from pancakesbot.events import (
+    plugin_host_done, plugin_host_failed, plugin_host_ready,
+    plugin_host_timeout
+)
+
+# Messages are small tuples, led by their kind.
+# Bot to host:
+EVENT = 0       # (EVENT, name, args) for the plugins channel
+COMMAND = 1     # (COMMAND, call id, handler key, user, target, text)
+STOP = 2        # (STOP,)
+# Host to bot:
+# (READY, event names handled, [(key, names, doc, timeout), ...])
+READY = 3
+FAILED = 4      # (FAILED, error)
+FIRE = 5        # (FIRE, name, args, kwargs) for the bot channel
+DONE = 6        # (DONE, call id)
+
+# Seconds to wait for a host to load its plugin, and to exit
+START_TIMEOUT = 10.0
+STOP_TIMEOUT = 2.0
+
+# Spawned rather than forked, so hosts don't inherit the bot's threads,
+# sockets and database connections
+_context = multiprocessing.get_context('spawn')
+
+# name: Event subclass, so relayed events don't make a class each time
+_event_types = {}
+
+
+def _send(conn, message):
+    conn.send_bytes(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+
+def _recv(conn):
+    return pickle.loads(conn.recv_bytes())
+
+
+def _event(name, args, kwargs=None):
+    event_type = _event_types.get(name)
+    if event_type is None:
+        event_type = _event_types[name] = type(Event.create(name))
+    return event_type(*args, **(kwargs or {}))
+
+
+class RemoteCommand:
+    """Command handler that runs a hosted plugin's command in its host"""
+
+    def __init__(self, host, key, name, doc, timeout):
+        self.host = host
+        self.key = key
+        self.name = name
+        # Read by Command for the help text and timeout
+        self.__doc__ = doc or ''
+        self.timeout = timeout
+
+    def __call__(self, user, target, args):
+        self.host.call_command(self, user, target, args)
+
+
+class PluginHost(Component):
+    """Runs a plugin in a worker process of its own.
+
+    The host imports the plugin and sends back which events it handles
+    and which commands it has, after which plugin_host_ready is fired.
+    Those events are relayed to it as they are fired on the plugins
+    channel, and whatever the plugin fires on the bot channel, i.e. every
+    BasePlugin action, is fired here in turn, so the plugin's CPU time
+    and memory stay out of the bot's process and a crash only loses the
+    plugin. If the host fails to start, or exits, plugin_host_failed is
+    fired instead.
+
+    Commands run one at a time in the host. Each call is timed, and
+    plugin_host_timeout is fired for one that doesn't finish in time.
+
+    Events and actions cross the pipe pickled, so their arguments have to
+    be picklable. Users are sent with their id resolved.
+    """
+
+    channel = "plugins"
+
+    def init(self, bot, fqplugin):
+        self.logger = logging.getLogger(__name__)
+        self.bot = bot
+        self.fqplugin = fqplugin
+        self.closing = False
+        # Set when a command timed out, the host won't answer STOP then
+        self.stuck = False
+        # Nothing is relayed until the host is ready
+        self.relayed = frozenset()
+        # [(command names, RemoteCommand), ...]
+        self.commands = []
+        # call id: (RemoteCommand, user, target, Timer or None)
+        self.calls = {}
+        self._call_ids = count()
+        self.conn, child = _context.Pipe()
+        settings = {
+            'channel': bot.channel,
+            'nick': bot.nick,
+            'command_prefix': bot.command_prefix,
+            'admin_prefix': bot.admin_prefix,
+            'log_level': logging.getLogger().level,
+        }
+        self.process = _context.Process(target=_host_main,
+                                        args=(child, fqplugin, settings),
+                                        name="host " + fqplugin,
+                                        daemon=True)
+        self.process.start()
+        child.close()
+        self.start_timer = Timer(START_TIMEOUT,
+                                 plugin_host_failed(self, "didn't start"),
+                                 bot.channel).register(self)
+        self.reader = threading.Thread(target=self._read,
+                                       name="host reader " + fqplugin,
+                                       daemon=True)
+        self.reader.start()
+
+    def send(self, message):
+        try:
+            _send(self.conn, message)
+        except (OSError, ValueError) as e:
+            if not self.closing:
+                self.logger.error("Plugin host \"{}\": Send failed: {}"
+                                  .format(self.fqplugin, e))
+
+    def call_command(self, remote, user, target, args):
+        """Runs a command in the host, timing it out if it's slow"""
+        call_id = next(self._call_ids)
+        timeout = (remote.timeout if remote.timeout is not None
+                   else self.bot.command_timeout)
+        timer = None
+        if timeout:
+            timer = Timer(timeout, plugin_host_timeout(self, call_id),
+                          self.bot.channel).register(self)
+        self.calls[call_id] = (remote, user, target, timer)
+        self.send((COMMAND, call_id, remote.key, user, target, args))
+
+    def finish_command(self, call_id):
+        """Forgets a call, returns its (RemoteCommand, user, target)"""
+        call = self.calls.pop(call_id, None)
+        if call is None:
+            return None
+        remote, user, target, timer = call
+        if timer is not None:
+            timer.unregister()
+        return remote, user, target
+
+    def take_ready(self, reply):
+        """Takes in the READY message, once the host has sent it"""
+        if self.start_timer is not None:
+            self.start_timer.unregister()
+            self.start_timer = None
+        kind, handles, commands = reply
+        self.relayed = frozenset(handles)
+        self.commands = [(names, RemoteCommand(self, key, names[0], doc,
+                                               timeout))
+                         for key, names, doc, timeout in commands]
+        self.logger.info("Plugin host \"{}\": Started, pid {}."
+                         .format(self.fqplugin, self.process.pid))
+
+    @handler(channel="plugins")
+    def _relay(self, event, *args, **kwargs):
+        if event.name in self.relayed and self.channel in event.channels:
+            self.send((EVENT, event.name, args))
+
+    def _read(self):
+        # Firing is thread safe
+        reason = None
+        while True:
+            try:
+                message = _recv(self.conn)
+            except (EOFError, OSError, TypeError, ValueError):
+                # TypeError and ValueError if close() closed the pipe
+                break
+            if self.closing:
+                # Whatever a host being stopped still sends is dropped
+                continue
+            kind = message[0]
+            if kind == FIRE:
+                kind, name, args, kwargs = message
+                self.fire(_event(name, args, kwargs), self.bot.channel)
+            elif kind == DONE:
+                self.fire(plugin_host_done(self, message[1]),
+                          self.bot.channel)
+            elif kind == READY:
+                self.fire(plugin_host_ready(self, message), self.bot.channel)
+            elif kind == FAILED:
+                reason = "failed: {}".format(message[1])
+        if not self.closing:
+            if reason is None:
+                self.process.join(STOP_TIMEOUT)
+                reason = "exited with code {}".format(self.process.exitcode)
+            self.fire(plugin_host_failed(self, reason), self.bot.channel)
+
+    def close(self):
+        """Stops the host process, killing it if it doesn't exit, or
+        right away if it is stuck.
+        """
+        self.closing = True
+        if self.start_timer is not None:
+            self.start_timer.unregister()
+            self.start_timer = None
+        for call_id in list(self.calls):
+            self.finish_command(call_id)
+        if self.process.is_alive() and not self.stuck:
+            self.send((STOP,))
+            self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            # Killed, as the host's loop would only see SIGTERM once the
+            # plugin lets go of it
+            self.process.kill()
+            self.process.join(STOP_TIMEOUT)
+        # The reader sees the pipe close once the process is gone
+        self.reader.join(STOP_TIMEOUT)
+        self.conn.close()
+
+
+class HostedBot:
+    """What a hosted plugin gets as its bot.
+
+    Only settings are copied over. The bot's state, such as the user
+    manager, roster and send queue, stays in the bot's process, and
+    BasePlugin actions are relayed there instead.
+    """
+
+    def __init__(self, settings):
+        self.channel = settings['channel']
+        self.nick = settings['nick']
+        self.command_prefix = settings['command_prefix']
+        self.admin_prefix = settings['admin_prefix']
+
+    def __getattr__(self, name):
+        raise AttributeError("\"{}\" isn't available to hosted plugins."
+                             .format(name))
+
+
+class _HostRoot(Component):
+    """Root component of a host process, owning the hosted plugin"""
+
+    channel = "host"
+
+    def init(self, conn, settings):
+        self.logger = logging.getLogger(__name__)
+        self.conn = conn
+        self.bot = HostedBot(settings)
+        # Command handlers, indexed by the keys sent in READY
+        self.handlers = []
+
+    def load(self, fqplugin):
+        """Loads the plugin, returns the READY message describing it"""
+        imported = import_module(fqplugin)
+        handles = set()
+        commands = []
+        for name, PluginClass in getmembers(imported, isclass):
+            if (not issubclass(PluginClass, BasePlugin) or
+                    PluginClass is BasePlugin):
+                continue
+            instance = PluginClass(self.bot).register(self)
+            handles.update(instance.events())
+            for method_name in dir(instance):
+                method = getattr(instance, method_name)
+                if callable(method) and hasattr(method, 'commands'):
+                    commands.append((len(self.handlers),
+                                     list(method.commands),
+                                     getdoc(method),
+                                     getattr(method, 'timeout', None)))
+                    self.handlers.append(method)
+        if not commands and not handles:
+            raise TypeError("No members extended from BasePlugin")
+        return (READY, sorted(handles), commands)
+
+    def start_reader(self):
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        while True:
+            try:
+                message = _recv(self.conn)
+            except (EOFError, OSError):
+                message = (STOP,)
+            kind = message[0]
+            if kind == EVENT:
+                self.fire(_event(message[1], message[2]), "plugins")
+            elif kind == COMMAND:
+                self.fire(_event("host_command", message[1:]))
+            else:
+                self.fire(_event("host_stop", ()))
+                return
+
+    @handler("host_command")
+    def _on_command(self, call_id, key, user, target, args):
+        method = self.handlers[key]
+        try:
+            result = method(user, target, args)
+            # Anything returned is the reply, as for threaded commands
+            if result is not None:
+                method.__self__.reply(user, target, str(result))
+        finally:
+            _send(self.conn, (DONE, call_id))
+
+    @handler("host_stop")
+    def _on_stop(self):
+        self.stop()
+
+    @handler(channel="pancakesbot")
+    def _relay(self, event, *args, **kwargs):
+        # Events fired on every channel are circuits' own
+        if self.bot.channel not in event.channels:
+            return
+        _send(self.conn, (FIRE, event.name, args, kwargs))
+
+
+def _host_main(conn, fqplugin, settings):
+    """Entry point of a host process"""
+    logging.basicConfig(
+        level=settings['log_level'],
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    root = _HostRoot(conn, settings)
+    try:
+        ready = root.load(fqplugin)
+    except Exception as e:
+        _send(conn, (FAILED, str(e)))
+        return
+    _send(conn, ready)
+    root.start_reader()
+    root.run()
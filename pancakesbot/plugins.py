@@ -3,60 +3,193 @@
 
 import logging
 import sys
-from inspect import getmembers, isclass, getdoc
+from concurrent.futures import ThreadPoolExecutor
+from inspect import getmembers, isclass
 from importlib import import_module
 
-from circuits import Component, handler
+from circuits import Component, handler, Timer
 from circuits.tools import kill
-from circuits.protocols.irc import PRIVMSG
-
 from pancakesbot.baseplugin import BasePlugin
+from pancakesbot.commands import (
+    Command, CommandJob, CommandRecognizer, CommandTrie
+)
+from pancakesbot.events import (
+    command_done, command_timeout, enqueue_msg, on_command
+)
+from pancakesbot.exceptions import PluginError
+from pancakesbot.outbound import BULK
+from pancakesbot.pluginhost import PluginHost
+from pancakesbot.users import User
 
 
 class PluginManager(Component):
 
     channel = "pancakesbot"
 
-    def init(self, bot, command_prefix, plugin_prefix):
+    def init(self, bot, command_prefix, plugin_prefix, admin_prefix=None):
         self.logger = logging.getLogger(__name__)
         self.bot = bot
         self.command_prefix = command_prefix
+        self.recognizer = CommandRecognizer(command_prefix, admin_prefix,
+                                            bot.nick)
         self.plugin_prefix = plugin_prefix
         self.loaded = {}
-        self.commands = {}
+        # Threaded commands run here, at most command_queue_limit at a
+        # time counting those waiting for a thread
+        self.pool = ThreadPoolExecutor(max_workers=bot.command_threads)
+        self.jobs = set()
+        # Jobs given up on whose threads are still running
+        self.abandoned = 0
+        # command or alias: Command, for every loaded plugin. Replaced as a
+        # whole on load and unload, never modified in place.
+        self._index({})
 
     def reply(self, user, target, message):
+        # Help listings can run long, so they drain in the bulk lane
         if target.startswith("#"):
-            self.fire(PRIVMSG(target, message), "pancakesbot")
+            self.fire(enqueue_msg(target, message, BULK), "pancakesbot")
         else:
-            self.fire(PRIVMSG(user, message), "pancakesbot")
+            self.fire(enqueue_msg(user[0], message, BULK), "pancakesbot")
 
     @handler("on_text", channel="plugins")
     def _on_text(self, user, target, message):
-        nick_prefix = self.bot.nick + ": "
-        if message.startswith(self.command_prefix):
-            args = message[1:].split(' ')
-        elif message.startswith(nick_prefix):
-            prefix_len = len(nick_prefix)
-            args = message[prefix_len:].split(' ')
-        else:
+        command = self.recognizer.parse(message, self.bot.nick)
+        if command is not None:
+            self.fire(on_command(user, target, command), "plugins")
+
+    @handler("on_command", channel="plugins")
+    def _on_command(self, user, target, command):
+        if not (command.prefixed or command.addressed):
             return
-        command = args[0]
-        if command == "help":
-            self._print_help(user, target, args[1:])
-        else:
-            for plugin in self.commands:
-                commands = self.commands[plugin]
-                if command in commands:
-                    func = commands[command]
-                    self.logger.info("User {} ({}) "
-                                     "Command \"{}\" "
-                                     "Executing Plugin \"{}\""
-                                     .format(user[0],
-                                             user[3],
-                                             command,
-                                             plugin))
-                    func(user, target, ' '.join(args[1:]))
+        if command.name == "help":
+            self._print_help(user, target, command.args)
+            return
+        entry, candidates = self.lookup(command.name)
+        # Admin commands aren't in the index, so no suggestions for
+        # those, unless the admin prefix is the command prefix too
+        if candidates and (command.prefixed or not command.admin):
+            self.reply(user, target, "Did you mean {}?".format(
+                ', '.join(self.command_prefix + name for name in candidates)))
+        if entry is not None:
+            self.logger.info("User {} ({}) "
+                             "Command \"{}\" "
+                             "Executing Plugin \"{}\""
+                             .format(user[0],
+                                     user.known_id,
+                                     command.name,
+                                     entry.plugin))
+            if entry.threaded:
+                self._submit(entry, user, target, command.text)
+            else:
+                entry.handler(user, target, command.text)
+
+    def _submit(self, entry, user, target, text):
+        """Runs a threaded command in the pool, timing it out if it's slow"""
+        # Timed out calls hold on to their thread until they return
+        if (len(self.jobs) >= self.bot.command_queue_limit or
+                self.abandoned >= self.bot.command_threads):
+            self.reply(user, target, "Busy, try {}{} again later."
+                                     .format(self.command_prefix, entry.name))
+            return
+        # Resolve the id here, the user manager isn't thread safe
+        user = User(*user)
+        job = CommandJob(entry, user, target,
+                         self.pool.submit(entry.handler, user, target, text))
+        self.jobs.add(job)
+        timeout = (entry.timeout if entry.timeout is not None
+                   else self.bot.command_timeout)
+        if timeout:
+            job.timer = Timer(timeout, command_timeout(job),
+                              self.channel).register(self)
+        # Called from the worker thread, firing is thread safe
+        job.future.add_done_callback(
+            lambda future: self.fire(command_done(job), self.channel))
+
+    def command_done(self, job):
+        if job not in self.jobs:
+            # Cancelled before it started
+            return
+        self._finish(job)
+        if job.abandoned:
+            # Already answered, its thread is free again
+            self.abandoned -= 1
+            return
+        try:
+            result = job.future.result()
+        except Exception as e:
+            self.logger.error("Command \"{}\" of Plugin \"{}\" failed: {}"
+                              .format(job.command.name,
+                                      job.command.plugin,
+                                      e))
+            self.reply(job.user, job.target, "{}{} failed."
+                       .format(self.command_prefix, job.command.name))
+            return
+        # Anything returned is the reply
+        if result is not None:
+            job.command.handler.__self__.reply(job.user, job.target,
+                                               str(result))
+
+    def command_timeout(self, job):
+        if job not in self.jobs or job.abandoned:
+            return
+        job.timer = None
+        self._abandon(job)
+        self.logger.warning("Command \"{}\" of Plugin \"{}\" timed out."
+                            .format(job.command.name, job.command.plugin))
+        self.reply(job.user, job.target, "{}{} timed out."
+                   .format(self.command_prefix, job.command.name))
+
+    def _abandon(self, job):
+        """Gives up on a job, cancelling it if it hasn't started.
+
+        A running thread can't be interrupted, so the job stays in jobs,
+        counted against the limits, until it returns and its result is
+        discarded.
+        """
+        if job.timer is not None:
+            job.timer.unregister()
+            job.timer = None
+        if job.future.cancel():
+            self._finish(job)
+        elif not job.abandoned:
+            job.abandoned = True
+            self.abandoned += 1
+
+    def _finish(self, job):
+        self.jobs.discard(job)
+        if job.timer is not None:
+            job.timer.unregister()
+            job.timer = None
+
+    def shutdown(self):
+        """Drops waiting threaded commands, without waiting on running
+        ones, and stops plugin hosts.
+        """
+        for job in list(self.jobs):
+            self._abandon(job)
+        self.pool.shutdown(wait=False)
+        for instances in self.loaded.values():
+            for instance in instances:
+                if isinstance(instance, PluginHost):
+                    instance.close()
+
+    def lookup(self, word):
+        """Finds the Command for word, which may be an abbreviation.
+
+        Returns (command, []) for a command or an abbreviation only one
+        command starts with, else (None, names) with the commands an
+        ambiguous abbreviation or a typo could have meant, if any.
+        """
+        entry = self.commands.get(word)
+        if entry is not None:
+            return entry, []
+        names = self.trie.complete(word)
+        if not names:
+            return None, self.trie.suggest(word)
+        # Aliases of one handler don't make an abbreviation ambiguous
+        if len(set(self.commands[name].handler for name in names)) == 1:
+            return self.commands[names[0]], []
+        return None, names
 
     def _print_help(self, user, target, args):
         # general or command specific help
@@ -67,34 +200,26 @@ class PluginManager(Component):
                     command = arg[1:]
                 else:
                     command = arg
-                for plugin in self.commands:
-                    if command in self.commands[plugin]:
-                        method = self.commands[plugin][command]
-                        if hasattr(method, '__doc__'):
-                            reply = "{}: {}".format(command, getdoc(method))
-                        else:
-                            reply = "No help text."
-                        for line in reply.split('\n'):
-                            self.reply(user, target, line)
+                entry, candidates = self.lookup(command)
+                if entry is not None:
+                    for line in entry.help.split('\n'):
+                        self.reply(user, target, line)
         else:
             # List of commands
-            for plugin in self.commands:
-                commands_list = []
-                plugin_name = plugin.split('.')[1]
-                for command in self.commands[plugin]:
-                    commands_list.append(self.command_prefix + str(command))
-                self.reply(user,
-                           target,
-                           plugin_name + ': ' + ', '.join(commands_list))
+            for line in self.listing:
+                self.reply(user, target, line)
 
     def load(self, plugin_name):
         try:
             fqplugin = "{0:s}.{1:s}".format(self.plugin_prefix, plugin_name)
-            if fqplugin in sys.modules:
+            if fqplugin in sys.modules or fqplugin in self.loaded:
                 self.logger.error("Plugin \"{}\": Unloading before reload."
                                   .format(plugin_name))
                 self.unload(plugin_name)
 
+            if plugin_name in self.bot.hosted_plugins:
+                self._load_hosted(fqplugin)
+                return
             # Import plugin
             imported = import_module(fqplugin)
             self._load_members(fqplugin, imported)
@@ -107,6 +232,7 @@ class PluginManager(Component):
     def _load_members(self, fqplugin, imported):
         try:
             plugin_members = getmembers(imported, self._base_predicate)
+            commands = {}
             if not plugin_members:
                 if fqplugin in sys.modules:
                     del sys.modules[fqplugin]
@@ -126,16 +252,18 @@ class PluginManager(Component):
                 for method_name in dir(instance):
                     method = getattr(instance, method_name)
                     if callable(method) and hasattr(method, 'commands'):
-                        if fqplugin not in self.commands:
-                            self.commands[fqplugin] = {}
                         for command in method.commands:
-                            self.commands[fqplugin][command] = method
+                            self._check_command(command, commands)
+                            commands[command] = Command(command,
+                                                        fqplugin,
+                                                        method)
                             self.logger.info("Plugin \"{}\": "
                                              "Added Command \"{}\"."
                                              .format(fqplugin, command))
                 self.logger.info("Plugin \"{}\": "
                                  "Loaded \"{}\"."
                                  .format(fqplugin, name))
+            self._index(dict(self.commands, **commands))
             return True
         except Exception as e:
             self._clean_plugin(fqplugin, unload=True)
@@ -144,6 +272,84 @@ class PluginManager(Component):
                                                               e))
             raise
 
+    def _load_hosted(self, fqplugin):
+        """Starts a plugin in a process of its own. Its commands are added
+        once plugin_host_ready says it has loaded.
+        """
+        host = PluginHost(self.bot, fqplugin).register(self)
+        self.loaded[fqplugin] = {host}
+
+    def _is_loaded(self, host):
+        """False for hosts already unloaded or replaced by a reload"""
+        return host in self.loaded.get(host.fqplugin, ())
+
+    def plugin_host_ready(self, host, reply):
+        if not self._is_loaded(host):
+            return
+        host.take_ready(reply)
+        fqplugin = host.fqplugin
+        try:
+            commands = {}
+            for names, remote in host.commands:
+                for command in names:
+                    self._check_command(command, commands)
+                    commands[command] = Command(command, fqplugin, remote)
+                    self.logger.info("Plugin \"{}\": "
+                                     "Added Hosted Command \"{}\"."
+                                     .format(fqplugin, command))
+        except PluginError as e:
+            self.logger.error("Plugin \"{}\": "
+                              "Failed to host: {} ".format(fqplugin, e))
+            self._clean_plugin(fqplugin)
+            return
+        self._index(dict(self.commands, **commands))
+
+    def plugin_host_failed(self, host, reason):
+        if self._is_loaded(host):
+            self.logger.error("Plugin \"{}\": Host {}."
+                              .format(host.fqplugin, reason))
+            self._clean_plugin(host.fqplugin)
+
+    def plugin_host_done(self, host, call_id):
+        host.finish_command(call_id)
+
+    def plugin_host_timeout(self, host, call_id):
+        call = host.finish_command(call_id)
+        if call is None or not self._is_loaded(host):
+            return
+        remote, user, target = call
+        self.logger.warning("Command \"{}\" of Plugin \"{}\" timed out, "
+                            "restarting its host."
+                            .format(remote.name, host.fqplugin))
+        self.reply(user, target, "{}{} timed out."
+                   .format(self.command_prefix, remote.name))
+        # Hosts run one command at a time, so everything after this one
+        # is stuck behind it until the host is replaced
+        host.stuck = True
+        self.load(host.fqplugin.split('.', 1)[1])
+
+    def _check_command(self, command, commands):
+        """Raises PluginError if command is taken"""
+        if command == "help":
+            raise PluginError("Command \"help\" is reserved.")
+        taken = commands.get(command) or self.commands.get(command)
+        if taken is not None:
+            raise PluginError("Command \"{}\" is already provided by "
+                              "\"{}\"."
+                              .format(command, taken.plugin))
+
+    def _index(self, commands):
+        """Swaps in a new command index and its help listing"""
+        by_plugin = {}
+        for command in sorted(commands):
+            by_plugin.setdefault(commands[command].plugin, []).append(
+                self.command_prefix + command)
+        self.listing = ["{}: {}".format(plugin.split('.')[1],
+                                        ', '.join(names))
+                        for plugin, names in sorted(by_plugin.items())]
+        self.trie = CommandTrie(commands)
+        self.commands = commands
+
     def _base_predicate(self, x):
         if isclass(x) and issubclass(x, BasePlugin):
             if x is not BasePlugin:
@@ -166,12 +372,18 @@ class PluginManager(Component):
         try:
             instances = self.loaded[fqplugin]
             for instance in instances:
+                if isinstance(instance, PluginHost):
+                    instance.close()
                 if hasattr(instance, "unregister"):
                     instance.unregister()
                 kill(instance)
             del(instances)
-            if fqplugin in self.commands:
-                del self.commands[fqplugin]
+            for job in list(self.jobs):
+                if job.command.plugin == fqplugin:
+                    self._abandon(job)
+            self._index(dict((command, entry)
+                             for command, entry in self.commands.items()
+                             if entry.plugin != fqplugin))
             if fqplugin in self.loaded:
                 del self.loaded[fqplugin]
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _v1_initial(c):
+    """Original schema, as created by early versions of UserManager"""
+    # Primary Table
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS users (
+                  id INTEGER PRIMARY KEY NOT NULL,
+                  last_nick TEXT COLLATE NOCASE,
+                  last_ident TEXT COLLATE NOCASE,
+                  last_vhost TEXT COLLATE NOCASE,
+                  modified DATE,
+                  created DATE
+              )
+              """)
+    # nicks table
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS nicks (
+                  id INTEGER PRIMARY KEY NOT NULL,
+                  nick TEXT COLLATE NOCASE,
+                  user_id INTEGER,
+                  modified DATE,
+                  created DATE,
+                  FOREIGN KEY(user_id) REFERENCES users(id)
+              )
+              """)
+    # vhosts table
+    c.execute("""
+              CREATE TABLE IF NOT EXISTS vhosts (
+                  id INTEGER PRIMARY KEY NOT NULL,
+                  vhost TEXT COLLATE NOCASE,
+                  user_id INTEGER,
+                  modified DATE,
+                  created DATE,
+                  FOREIGN KEY(user_id) REFERENCES users(id)
+              )
+              """)
+
+
+def _epoch(column):
+    """SQL expression converting a datetime string column to epoch seconds"""
+    return ("CASE WHEN typeof({0}) = 'text' "
+            "THEN CAST(strftime('%s', {0}) AS INTEGER) "
+            "ELSE {0} END".format(column))
+
+
+def _v2_constraints(c):
+    """Rebuilds the tables with UNIQUE sightings and epoch timestamps.
+
+    Duplicate nick/vhost rows are collapsed, keeping the earliest created
+    and latest modified times. The UNIQUE constraints inherit the NOCASE
+    collation of their columns, so their indexes serve the nick and vhost
+    lookups.
+    """
+    c.execute("""
+              CREATE TABLE users_v2 (
+                  id INTEGER PRIMARY KEY NOT NULL,
+                  last_nick TEXT COLLATE NOCASE,
+                  last_ident TEXT COLLATE NOCASE,
+                  last_vhost TEXT COLLATE NOCASE,
+                  modified INTEGER,
+                  created INTEGER
+              )
+              """)
+    c.execute("""
+              INSERT INTO users_v2
+              SELECT id, last_nick, last_ident, last_vhost, {}, {}
+              FROM users
+              """.format(_epoch('modified'), _epoch('created')))
+    c.execute("DROP TABLE users")
+    c.execute("ALTER TABLE users_v2 RENAME TO users")
+
+    for table, column in (('nicks', 'nick'), ('vhosts', 'vhost')):
+        c.execute("""
+                  CREATE TABLE {0}_v2 (
+                      id INTEGER PRIMARY KEY NOT NULL,
+                      {1} TEXT COLLATE NOCASE NOT NULL,
+                      user_id INTEGER NOT NULL,
+                      modified INTEGER,
+                      created INTEGER,
+                      UNIQUE({1}, user_id),
+                      FOREIGN KEY(user_id) REFERENCES users(id)
+                  )
+                  """.format(table, column))
+        c.execute("""
+                  INSERT INTO {0}_v2 ({1}, user_id, modified, created)
+                  SELECT {1}, user_id, MAX({2}), MIN({3})
+                  FROM {0}
+                  WHERE {1} IS NOT NULL
+                      AND user_id IN (SELECT id FROM users)
+                  GROUP BY {1}, user_id
+                  """.format(table,
+                             column,
+                             _epoch('modified'),
+                             _epoch('created')))
+        c.execute("DROP TABLE {}".format(table))
+        c.execute("ALTER TABLE {0}_v2 RENAME TO {0}".format(table))
+        c.execute("CREATE INDEX {0}_user_id ON {0}(user_id)".format(table))
+
+
+# Each migration upgrades the database by one PRAGMA user_version.
+# Append new migrations, never edit or reorder released ones.
+MIGRATIONS = [
+    _v1_initial,
+    _v2_constraints,
+]
+
+
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Upgrades conn to the latest schema version, one step at a time.
+
+    Each step runs in its own transaction together with the version bump,
+    so an interrupted upgrade resumes where it left off.
+    """
+    current = version(conn)
+    if current > len(MIGRATIONS):
+        raise RuntimeError("User DB schema version {} is newer than "
+                           "supported version {}."
+                           .format(current, len(MIGRATIONS)))
+    for number in range(current + 1, len(MIGRATIONS) + 1):
+        migration = MIGRATIONS[number - 1]
+        logger.info("Migrating user DB to version {} ({})."
+                    .format(number, migration.__name__))
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN")
+            migration(c)
+            c.execute("PRAGMA user_version = {:d}".format(number))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception("User DB migration to version {} failed."
+                             .format(number))
+            raise
+    return len(MIGRATIONS)
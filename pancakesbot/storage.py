@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from pancakesbot import schema
+from pancakesbot.database import DBExecutor
+
+
+# The following run on DBExecutor threads and only touch their connection.
+
+def _sql_find(conn, table, column, value, user_id=None):
+    if user_id is None:
+        row = conn.execute("SELECT user_id FROM {} WHERE {}=?"
+                           .format(table, column),
+                           (value,)).fetchone()
+    else:
+        row = conn.execute("SELECT user_id FROM {} WHERE {}=? AND user_id=?"
+                           .format(table, column),
+                           (value, user_id)).fetchone()
+    return row[0] if row else None
+
+
+def _sql_last_seen(conn, user_id):
+    return conn.execute("SELECT last_nick, last_vhost FROM users WHERE id=?",
+                        (user_id,)).fetchone()
+
+
+def _sql_max_id(conn):
+    return conn.execute("SELECT MAX(id) FROM users").fetchone()[0] or 0
+
+
+def _sql_select_in(conn, sql, values, chunk=500):
+    """Runs sql once per chunk of values, filling in its IN (...) list"""
+    values = list(values)
+    for start in range(0, len(values), chunk):
+        part = values[start:start + chunk]
+        for row in conn.execute(sql.format(', '.join('?' * len(part))),
+                                part):
+            yield row
+
+
+def _sql_lookup_many(conn, nicks, vhosts):
+    """Set-based version of the lookups id_from_user does per user.
+
+    Returns ({nick: user_id}, {vhost: user_id}, {user_id: last seen row})
+    with nicks and vhosts lowercased.
+    """
+    nick_ids = {}
+    for nick, user_id in _sql_select_in(
+            conn, "SELECT nick, user_id FROM nicks WHERE nick IN ({})",
+            nicks):
+        nick_ids.setdefault(nick.lower(), user_id)
+    vhost_ids = {}
+    for vhost, user_id in _sql_select_in(
+            conn, "SELECT vhost, user_id FROM vhosts WHERE vhost IN ({})",
+            vhosts):
+        vhost_ids.setdefault(vhost.lower(), user_id)
+    ids = set(nick_ids.values()) | set(vhost_ids.values())
+    last = {}
+    for user_id, last_nick, last_vhost in _sql_select_in(
+            conn,
+            "SELECT id, last_nick, last_vhost FROM users WHERE id IN ({})",
+            ids):
+        last[user_id] = (last_nick, last_vhost)
+    return nick_ids, vhost_ids, last
+
+
+def _sql_ids(conn):
+    return conn.execute("SELECT id FROM users").fetchall()
+
+
+def _sql_users_page(conn, after, count, pattern=None):
+    """Up to count users with ids above after, optionally by nick pattern"""
+    if pattern is None:
+        return conn.execute("""
+                            SELECT id, last_nick, last_vhost
+                            FROM users
+                            WHERE id > ?
+                            ORDER BY id
+                            LIMIT ?
+                            """, (after, count)).fetchall()
+    return conn.execute("""
+                        SELECT DISTINCT u.id, u.last_nick, u.last_vhost
+                        FROM users u
+                        JOIN nicks n ON n.user_id = u.id
+                        WHERE u.id > ? AND n.nick LIKE ? ESCAPE '\\'
+                        ORDER BY u.id
+                        LIMIT ?
+                        """, (after, pattern, count)).fetchall()
+
+
+def _like_pattern(mask):
+    """Converts an IRC style * and ? wildcard mask to a LIKE pattern"""
+    escaped = (mask.replace('\\', '\\\\')
+                   .replace('%', '\\%')
+                   .replace('_', '\\_'))
+    return escaped.replace('*', '%').replace('?', '_')
+
+
+def _sql_write_batch(conn, batch):
+    c = conn.cursor()
+    c.executemany("""
+                  INSERT INTO users (
+                      id,
+                      last_nick,
+                      last_vhost,
+                      modified,
+                      created
+                  ) VALUES(?, ?, ?, ?, ?)
+                  """, batch.new_users.values())
+    c.executemany("UPDATE users SET last_nick=?, modified=? WHERE id=?",
+                  batch.last_nick.values())
+    c.executemany("UPDATE users SET last_vhost=?, modified=? WHERE id=?",
+                  batch.last_vhost.values())
+    c.executemany("""
+                  INSERT OR IGNORE INTO nicks (
+                      nick,
+                      user_id,
+                      modified,
+                      created
+                  ) VALUES(?, ?, ?, ?)
+                  """, batch.nicks.values())
+    c.executemany("""
+                  INSERT OR IGNORE INTO vhosts (
+                      vhost,
+                      user_id,
+                      modified,
+                      created
+                  ) VALUES(?, ?, ?, ?)
+                  """, batch.vhosts.values())
+    conn.commit()
+
+
+def _sql_merge(conn, merges, now):
+    """Applies {from_id: to_id} merges in one set-based transaction"""
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("""
+              CREATE TEMP TABLE IF NOT EXISTS merge_map (
+                  from_id INTEGER PRIMARY KEY NOT NULL,
+                  to_id INTEGER NOT NULL
+              )
+              """)
+    c.execute("DELETE FROM merge_map")
+    c.executemany("INSERT INTO merge_map (from_id, to_id) VALUES(?, ?)",
+                  merges.items())
+    for table in ('nicks', 'vhosts'):
+        # Rows both users already share stay behind and get dropped
+        c.execute("""
+                  UPDATE OR IGNORE {0} SET
+                      user_id=(SELECT to_id FROM merge_map
+                               WHERE from_id={0}.user_id),
+                      modified=?
+                  WHERE user_id IN (SELECT from_id FROM merge_map)
+                  """.format(table), (now,))
+        c.execute("""
+                  DELETE FROM {}
+                  WHERE user_id IN (SELECT from_id FROM merge_map)
+                  """.format(table))
+    c.execute("DELETE FROM users WHERE id IN (SELECT from_id FROM merge_map)")
+    c.execute("DELETE FROM merge_map")
+    conn.commit()
+    return len(merges)
+
+
+def _sql_shared_ids(conn):
+    """Groups of user ids that share a vhost"""
+    return [[int(user_id) for user_id in ids.split(',')]
+            for (ids,) in conn.execute("""
+                                       SELECT group_concat(user_id)
+                                       FROM vhosts
+                                       GROUP BY vhost
+                                       HAVING COUNT(*) > 1
+                                       """)]
+
+
+def _resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class IdentityStore:
+    """Where UserManager keeps users and their nick/vhost sightings.
+
+    Every method returns a concurrent.futures.Future. Writes complete in
+    the order they were submitted, and shared_ids() runs after all writes
+    submitted before it. kind is either 'nick' or 'vhost'; nicks and
+    vhosts compare case-insensitively.
+    """
+
+    def find(self, kind, value, user_id=None):
+        """A user id seen with value, or user_id if that pair exists"""
+        raise NotImplementedError
+
+    def lookup_many(self, nicks, vhosts):
+        """({nick: id}, {vhost: id}, {id: (last_nick, last_vhost)}),
+        keyed by lowercased nicks and vhosts"""
+        raise NotImplementedError
+
+    def last_seen(self, user_id):
+        """(last_nick, last_vhost) of user_id, or None"""
+        raise NotImplementedError
+
+    def max_id(self):
+        raise NotImplementedError
+
+    def ids(self):
+        """[(id,), ...] for every user"""
+        raise NotImplementedError
+
+    def users_page(self, after, count, mask=None):
+        """Up to count (id, last_nick, last_vhost) rows with ids above
+        after, in id order, optionally only users with a nick matching
+        the * and ? wildcard mask"""
+        raise NotImplementedError
+
+    def shared_ids(self):
+        """Lists of user ids sharing a vhost"""
+        raise NotImplementedError
+
+    def write_batch(self, batch):
+        """Writes a UserManager batch of sightings atomically"""
+        raise NotImplementedError
+
+    def merge(self, merges, now):
+        """Applies {from_id: to_id} merges atomically"""
+        raise NotImplementedError
+
+    def close(self):
+        """Finishes pending writes and releases the store"""
+
+
+class SqliteStore(IdentityStore):
+    """Identities in a sqlite file, accessed through a DBExecutor"""
+
+    def __init__(self, dbfile, readers=2):
+        self.dbfile = dbfile
+        self.db = DBExecutor(dbfile, readers=readers, setup=self._setup)
+
+    def _setup(self, conn):
+        schema.migrate(conn)
+
+    def find(self, kind, value, user_id=None):
+        return self.db.read(_sql_find, kind + 's', kind, value, user_id)
+
+    def lookup_many(self, nicks, vhosts):
+        return self.db.read(_sql_lookup_many, nicks, vhosts)
+
+    def last_seen(self, user_id):
+        return self.db.read(_sql_last_seen, user_id)
+
+    def max_id(self):
+        return self.db.read(_sql_max_id)
+
+    def ids(self):
+        return self.db.read(_sql_ids)
+
+    def users_page(self, after, count, mask=None):
+        pattern = _like_pattern(mask) if mask else None
+        return self.db.read(_sql_users_page, after, count, pattern)
+
+    def shared_ids(self):
+        # Read on the writer so earlier writes are included
+        return self.db.write(_sql_shared_ids)
+
+    def write_batch(self, batch):
+        return self.db.write(_sql_write_batch, batch)
+
+    def merge(self, merges, now):
+        return self.db.write(_sql_merge, merges, now)
+
+    def close(self):
+        self.db.close()
+
+
+class MirroredSqliteStore(SqliteStore):
+    """sqlite :memory: database loaded from, and mirrored to, a file.
+
+    Lookups and commits never touch the disk; the whole database is
+    copied back to dbfile every mirror_interval seconds and on close.
+    Anything written since the last mirror is lost on a crash.
+    """
+
+    def __init__(self, dbfile, mirror_interval=60.0):
+        self.disk_file = dbfile
+        self.mirror_interval = mirror_interval
+        super(MirroredSqliteStore, self).__init__(':memory:', readers=0)
+        self._stopped = threading.Event()
+        self._mirror_thread = threading.Thread(target=self._mirror_loop,
+                                               name="db-mirror",
+                                               daemon=True)
+        self._mirror_thread.start()
+
+    def _setup(self, conn):
+        if os.path.exists(self.disk_file):
+            disk = sqlite3.connect(self.disk_file)
+            try:
+                disk.backup(conn)
+            finally:
+                disk.close()
+        schema.migrate(conn)
+
+    def _mirror(self, conn):
+        disk = sqlite3.connect(self.disk_file)
+        try:
+            conn.backup(disk)
+        finally:
+            disk.close()
+
+    def _mirror_loop(self):
+        while not self._stopped.wait(self.mirror_interval):
+            self.db.write(self._mirror)
+
+    def close(self):
+        self._stopped.set()
+        self.db.write(self._mirror)
+        super(MirroredSqliteStore, self).close()
+
+
+class MemoryStore(IdentityStore):
+    """Plain dicts, snapshotted to a JSON file.
+
+    The fastest store, as every call completes before it returns. The
+    snapshot is written every snapshot_interval seconds on a background
+    thread and on close; anything newer is lost on a crash.
+    """
+
+    def __init__(self, snapshot_file=None, snapshot_interval=60.0):
+        self.logger = logging.getLogger(__name__)
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self._lock = threading.Lock()
+        # id: [last_nick, last_vhost, modified, created]
+        self.users = {}
+        # lowercased nick/vhost: {user_id: [nick/vhost, modified, created]}
+        self.sightings = {'nick': {}, 'vhost': {}}
+        self._dirty = False
+
+        if snapshot_file and os.path.exists(snapshot_file):
+            self._load()
+        self._stopped = threading.Event()
+        self._snapshot_thread = None
+        if snapshot_file and snapshot_interval > 0:
+            self._snapshot_thread = threading.Thread(
+                target=self._snapshot_loop,
+                name="store-snapshot",
+                daemon=True)
+            self._snapshot_thread.start()
+
+    def _load(self):
+        with open(self.snapshot_file) as snapshot:
+            data = json.load(snapshot)
+        for row in data['users']:
+            self.users[row[0]] = row[1:]
+        for kind in ('nick', 'vhost'):
+            for value, user_id, modified, created in data[kind + 's']:
+                seen = self.sightings[kind].setdefault(value.lower(), {})
+                seen[user_id] = [value, modified, created]
+
+    def snapshot(self):
+        """Writes the current state to snapshot_file"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {
+                'users': [[user_id] + row
+                          for user_id, row in self.users.items()],
+            }
+            for kind in ('nick', 'vhost'):
+                data[kind + 's'] = [[row[0], user_id, row[1], row[2]]
+                                    for seen in self.sightings[kind].values()
+                                    for user_id, row in seen.items()]
+            self._dirty = False
+        partial_file = self.snapshot_file + '.tmp'
+        with open(partial_file, 'w') as snapshot:
+            json.dump(data, snapshot)
+        os.replace(partial_file, self.snapshot_file)
+
+    def _snapshot_loop(self):
+        while not self._stopped.wait(self.snapshot_interval):
+            try:
+                self.snapshot()
+            except Exception:
+                self.logger.exception("Unable to snapshot user store.")
+
+    def _find(self, kind, value, user_id=None):
+        seen = self.sightings[kind].get(value.lower())
+        if not seen:
+            return None
+        if user_id is None:
+            return next(iter(seen))
+        return user_id if user_id in seen else None
+
+    def find(self, kind, value, user_id=None):
+        with self._lock:
+            return _resolved(self._find(kind, value, user_id))
+
+    def lookup_many(self, nicks, vhosts):
+        with self._lock:
+            nick_ids = {}
+            for nick in nicks:
+                user_id = self._find('nick', nick)
+                if user_id is not None:
+                    nick_ids[nick.lower()] = user_id
+            vhost_ids = {}
+            for vhost in vhosts:
+                user_id = self._find('vhost', vhost)
+                if user_id is not None:
+                    vhost_ids[vhost.lower()] = user_id
+            last = {}
+            for user_id in set(nick_ids.values()) | set(vhost_ids.values()):
+                if user_id in self.users:
+                    last[user_id] = tuple(self.users[user_id][:2])
+            return _resolved((nick_ids, vhost_ids, last))
+
+    def last_seen(self, user_id):
+        with self._lock:
+            row = self.users.get(user_id)
+            return _resolved(tuple(row[:2]) if row else None)
+
+    def max_id(self):
+        with self._lock:
+            return _resolved(max(self.users, default=0))
+
+    def ids(self):
+        with self._lock:
+            return _resolved([(user_id, ) for user_id in sorted(self.users)])
+
+    def users_page(self, after, count, mask=None):
+        with self._lock:
+            if mask:
+                matches = _mask_regex(mask).match
+                candidates = set(
+                    user_id
+                    for key, seen in self.sightings['nick'].items()
+                    if matches(key)
+                    for user_id in seen)
+            else:
+                candidates = self.users
+            page = sorted(user_id for user_id in candidates
+                          if user_id > after and user_id in self.users)
+            return _resolved([(user_id,
+                               self.users[user_id][0],
+                               self.users[user_id][1])
+                              for user_id in page[:count]])
+
+    def shared_ids(self):
+        with self._lock:
+            return _resolved([list(seen)
+                              for seen in self.sightings['vhost'].values()
+                              if len(seen) > 1])
+
+    def write_batch(self, batch):
+        with self._lock:
+            for user_id, nick, vhost, modified, created in \
+                    batch.new_users.values():
+                self.users[user_id] = [nick, vhost, modified, created]
+            for nick, modified, user_id in batch.last_nick.values():
+                if user_id in self.users:
+                    self.users[user_id][0] = nick
+                    self.users[user_id][2] = modified
+            for vhost, modified, user_id in batch.last_vhost.values():
+                if user_id in self.users:
+                    self.users[user_id][1] = vhost
+                    self.users[user_id][2] = modified
+            for kind, rows in (('nick', batch.nicks), ('vhost', batch.vhosts)):
+                for value, user_id, modified, created in rows.values():
+                    seen = self.sightings[kind].setdefault(value.lower(), {})
+                    if user_id not in seen:
+                        seen[user_id] = [value, modified, created]
+            self._dirty = True
+            return _resolved(None)
+
+    def merge(self, merges, now):
+        with self._lock:
+            for kind in ('nick', 'vhost'):
+                for seen in self.sightings[kind].values():
+                    for from_id in [user_id for user_id in seen
+                                    if user_id in merges]:
+                        row = seen.pop(from_id)
+                        row[1] = now
+                        seen.setdefault(merges[from_id], row)
+            for from_id in merges:
+                self.users.pop(from_id, None)
+            self._dirty = True
+            return _resolved(len(merges))
+
+    def close(self):
+        self._stopped.set()
+        if self.snapshot_file:
+            self.snapshot()
+
+
+def _mask_regex(mask):
+    """Compiles a * and ? wildcard mask matching lowercased values"""
+    pattern = re.escape(mask.lower()).replace('\\*', '.*').replace('\\?', '.')
+    return re.compile(pattern + r'\Z')
+
+
+def open_store(kind, path, readers=2, snapshot_interval=60.0):
+    """Creates the store named kind, keeping its data in path.
+
+    path is given without an extension; the sqlite stores add .db and
+    the memory store .json. readers only applies to 'sqlite', and
+    snapshot_interval to 'sqlite-memory' and 'memory'.
+    """
+    if kind == 'sqlite':
+        return SqliteStore(path + '.db', readers=readers)
+    elif kind == 'sqlite-memory':
+        return MirroredSqliteStore(path + '.db', snapshot_interval)
+    elif kind == 'memory':
+        return MemoryStore(path + '.json', snapshot_interval)
+    raise ValueError("Unknown user store \"{}\", expected sqlite, "
+                     "sqlite-memory or memory.".format(kind))
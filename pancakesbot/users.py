@@ -1,148 +1,442 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sqlite3
 import logging
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import wait as wait_futures
+from functools import partial
+from sys import intern
+from time import monotonic, time
 
-from circuits import Component
+from circuits import Component, Event, Timer, handler
+
+from pancakesbot.hostmask import hostmask
+from pancakesbot.storage import IdentityStore, SqliteStore
+
+
+class IdentityCache:
+    """Bounded LRU cache mapping (nick, ident, host) to a user id.
+
+    Entries expire after ttl seconds so that sightings still get written
+    back to the database every so often. Keys are lowercased to match the
+    NOCASE collation of the user tables.
+    """
+
+    def __init__(self, size=4096, ttl=600.0):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_id = {}
+
+    @staticmethod
+    def key(user):
+        return (user[0].lower(), user[1].lower(), user[2].lower())
+
+    def get(self, user):
+        key = self.key(user)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        user_id, expires = entry
+        if expires < monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return user_id
+
+    def put(self, user, user_id):
+        if self.size <= 0 or user_id is None:
+            return
+        key = self.key(user)
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (user_id, monotonic() + self.ttl)
+        self._keys_by_id.setdefault(user_id, set()).add(key)
+        while len(self._entries) > self.size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, user_id):
+        """Drops every entry resolving to user_id"""
+        for key in self._keys_by_id.pop(user_id, ()):
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_id.clear()
+
+    def _remove(self, key):
+        user_id, _ = self._entries.pop(key)
+        keys = self._keys_by_id.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_id[user_id]
+
+
+class IdentityClusters:
+    """Union-find over user ids.
+
+    Merged ids stay resolvable for the rest of the session: find() maps
+    any id that was merged away, including ids still sitting in caches,
+    plugins or unwritten batches, to the surviving (lowest) id.
+    """
+
+    def __init__(self):
+        self._parent = {}
+
+    def find(self, user_id):
+        parent = self._parent.get(user_id)
+        if parent is None:
+            return user_id
+        # Path halving keeps chains short without recursion
+        while parent in self._parent:
+            grandparent = self._parent[parent]
+            self._parent[user_id] = grandparent
+            user_id, parent = parent, grandparent
+        return parent
+
+    def union(self, ids):
+        """Joins ids into one cluster.
+
+        Returns (root, merged) where merged are the former roots that now
+        resolve to root.
+        """
+        roots = set(self.find(user_id) for user_id in ids
+                    if user_id is not None)
+        if not roots:
+            return None, set()
+        root = min(roots)
+        roots.discard(root)
+        for merged in roots:
+            self._parent[merged] = root
+        return root, roots
+
+
+class _Batch:
+    """Sightings waiting to be written, keyed so repeats collapse"""
+
+    __slots__ = ('new_users', 'last_nick', 'last_vhost',
+                 'nicks', 'nick_ids', 'vhosts', 'vhost_ids')
+
+    def __init__(self):
+        self.new_users = {}
+        self.last_nick = {}
+        self.last_vhost = {}
+        self.nicks = {}
+        self.nick_ids = {}
+        self.vhosts = {}
+        self.vhost_ids = {}
+
+    def __len__(self):
+        return (len(self.new_users) +
+                len(self.last_nick) +
+                len(self.last_vhost) +
+                len(self.nicks) +
+                len(self.vhosts))
+
+
+def _intern(text):
+    return intern(text) if text is not None else None
+
+
+class User:
+    """Immutable (nick, ident, host, id) user record.
+
+    Indexes, slices, iterates and compares like the 4-tuple it replaces,
+    so user[0] and user[3] keep working, while the slots and interned
+    strings keep it small when the roster and caches hold many of them.
+    The id may be left to a resolve((nick, ident, host)) callable, which
+    is only called the first time user[3] or .id is read, so events no
+    plugin looks closely at never touch the user DB. Use known_id to log
+    the id without resolving it.
+    """
+
+    __slots__ = ('nick', 'ident', 'host', '_id', '_resolve')
+
+    def __init__(self, nick, ident=None, host=None, id=None, resolve=None):
+        init = object.__setattr__
+        init(self, 'nick', _intern(nick))
+        init(self, 'ident', _intern(ident))
+        init(self, 'host', _intern(host))
+        init(self, '_id', id)
+        init(self, '_resolve', resolve if id is None else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("User is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("User is immutable")
+
+    @property
+    def id(self):
+        if self._resolve is not None:
+            resolve = self._resolve
+            object.__setattr__(self, '_resolve', None)
+            object.__setattr__(self, '_id',
+                               resolve((self.nick, self.ident, self.host)))
+        return self._id
+
+    @property
+    def known_id(self):
+        """The id if it has been resolved already, else None"""
+        return self._id
+
+    @property
+    def hostmask(self):
+        return hostmask(self)
+
+    def renamed(self, nick):
+        """The same user under a new nick"""
+        return User(nick, self.ident, self.host, self._id, self._resolve)
+
+    def _field(self, index):
+        if index == 3:
+            return self.id
+        return (self.nick, self.ident, self.host)[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self._field(i) for i in range(*index.indices(4)))
+        if index < 0:
+            index += 4
+        if not 0 <= index < 4:
+            raise IndexError("user index out of range")
+        return self._field(index)
+
+    def __len__(self):
+        return 4
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __add__(self, other):
+        return self[:] + tuple(other)
+
+    def __radd__(self, other):
+        return tuple(other) + self[:]
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, User)):
+            return self[:] == tuple(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self[:])
+
+    def __reduce__(self):
+        # The resolver can't leave this process, so the id is resolved
+        # before the user is pickled, e.g. to be sent to a plugin host
+        return (User, (self.nick, self.ident, self.host, self.id))
+
+    def __repr__(self):
+        user_id = self._id if self._resolve is None else '<unresolved>'
+        return "User({!r}, {!r}, {!r}, {})".format(self.nick,
+                                                   self.ident,
+                                                   self.host,
+                                                   user_id)
 
 
 class UserManager(Component):
+    """Resolves (nick, ident, host) users to ids, and remembers sightings.
+
+    Sightings are written behind, and WHO syncs and nick changes look
+    users up with lookup_users(), which doesn't wait. Other lookups that
+    miss both the cache and the unwritten sightings still wait on the
+    store: a user id read for the first time (user[3]), user_from_id,
+    and the admin listings, which flush and wait first. Events only pay
+    this when something actually reads the id.
+    """
 
     channel = "bot"
     logger = None
     bot = None
-    db_conn = None
+    store = None
+    cache = None
+
+    def init(self, bot, store, cache_size=4096, cache_ttl=600.0,
+             flush_interval=5.0, flush_size=256):
+        """Initializes the logging and sets up the identity store
 
-    def init(self, bot, dbfile):
-        """Initializes the logging and sets storage directory"""
+        store is an IdentityStore, or the path of a sqlite database.
+        Sightings are buffered and handed to the store in one write
+        every flush_interval seconds, or once flush_size writes are
+        pending. A flush_interval of 0 hands over every sighting
+        immediately.
+        """
         self.logger = logging.getLogger(__name__)
         self.bot = bot
+        self.cache = IdentityCache(cache_size, cache_ttl)
+        self.clusters = IdentityClusters()
+
+        # Write-behind buffer, plus batches the store hasn't written yet
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._batch = _Batch()
+        self._inflight = []
+        # Last write or merge handed to the store
+        self._last_write = None
 
         self.logger.info("Establishing Connection to User DB.")
         try:
-            self.db_conn = sqlite3.connect(dbfile)
+            if not isinstance(store, IdentityStore):
+                store = SqliteStore(store)
+            self.store = store
         except Exception:
-            self.db_conn = None
+            self.store = None
             self.logger.exception("Unable to access local user database.")
             raise
 
-        c = self.db_conn.cursor()
-        # Primary Table
-        c.execute("""
-                  CREATE TABLE IF NOT EXISTS users (
-                      id INTEGER PRIMARY KEY NOT NULL,
-                      last_nick TEXT COLLATE NOCASE,
-                      last_ident TEXT COLLATE NOCASE,
-                      last_vhost TEXT COLLATE NOCASE,
-                      modified DATE,
-                      created DATE
-                  )
-                  """)
-        # nicks table
-        c.execute("""
-                  CREATE TABLE IF NOT EXISTS nicks (
-                      id INTEGER PRIMARY KEY NOT NULL,
-                      nick TEXT COLLATE NOCASE,
-                      user_id INTEGER,
-                      modified DATE,
-                      created DATE,
-                      FOREIGN KEY(user_id) REFERENCES users(id)
-                  )
-                  """)
-        # vhosts table
-        c.execute("""
-                  CREATE TABLE IF NOT EXISTS vhosts (
-                      id INTEGER PRIMARY KEY NOT NULL,
-                      vhost TEXT COLLATE NOCASE,
-                      user_id INTEGER,
-                      modified DATE,
-                      created DATE,
-                      FOREIGN KEY(user_id) REFERENCES users(id)
-                  )
-                  """)
-        self.db_conn.commit()
-
-    def _update_nick(self, user_id, nick):
-        c = self.db_conn.cursor()
-        c.execute("""
-                  UPDATE users SET
-                      last_nick=?,
-                      modified=?
-                  WHERE id=?
-                  """, (nick, datetime.utcnow(), user_id))
-        c.execute("SELECT id FROM nicks WHERE nick=? AND user_id=?",
-                  (nick, user_id))
-        nick_exists = c.fetchone()
-        if not nick_exists:
-            c.execute("""
-                      INSERT OR REPLACE INTO nicks (
-                          nick,
-                          user_id,
-                          modified,
-                          created
-                      ) VALUES(?, ?, ?, ?)
-                      """, (nick,
-                            user_id,
-                            datetime.utcnow(),
-                            datetime.utcnow()))
-        self.db_conn.commit()
-
-    def _update_vhost(self, user_id, vhost):
-        c = self.db_conn.cursor()
-        c.execute("""
-                  UPDATE users SET
-                      last_vhost=?,
-                      modified=?
-                  WHERE id=?
-                  """, (vhost, datetime.utcnow(), user_id))
-        c.execute("SELECT id FROM vhosts WHERE vhost=? AND user_id=?",
-                  (vhost, user_id))
-        vhost_exists = c.fetchone()
-        if not vhost_exists:
-            c.execute("""
-                      INSERT OR REPLACE INTO vhosts (
-                          vhost,
-                          user_id,
-                          modified,
-                          created
-                      ) VALUES(?, ?, ?, ?)
-                      """, (vhost,
-                            user_id,
-                            datetime.utcnow(),
-                            datetime.utcnow()))
-        self.db_conn.commit()
+        # Ids are handed out here so new users never wait on the store
+        self._next_id = self.store.max_id().result() + 1
 
-    def _new_user(self, user):
-        # User DB
-        c = self.db_conn.cursor()
+        if self.flush_interval > 0:
+            Timer(self.flush_interval,
+                  Event.create("flush_users"),
+                  self.channel,
+                  persist=True).register(self)
+
+    def _batches(self):
+        """Unwritten batches, newest first"""
+        return (self._batch,) + tuple(reversed(self._inflight))
+
+    def _update_nick(self, user_id, nick, exists=None):
+        now = int(time())
+        self._batch.last_nick[user_id] = (nick, now, user_id)
+        if exists is None:
+            exists = self._lookup_nick(nick, user_id) is not None
+        if not exists:
+            self._batch.nick_ids[nick.lower()] = user_id
+            self._batch.nicks[(nick.lower(), user_id)] = (nick,
+                                                          user_id,
+                                                          now,
+                                                          now)
+        self._maybe_flush()
+
+    def _update_vhost(self, user_id, vhost, exists=None):
+        now = int(time())
+        self._batch.last_vhost[user_id] = (vhost, now, user_id)
+        if exists is None:
+            exists = self._lookup_vhost(vhost, user_id) is not None
+        if not exists:
+            self._batch.vhost_ids[vhost.lower()] = user_id
+            self._batch.vhosts[(vhost.lower(), user_id)] = (vhost,
+                                                            user_id,
+                                                            now,
+                                                            now)
+        self._maybe_flush()
+
+    def _pending_nick(self, nick, user_id=None):
+        key = nick.lower()
+        for batch in self._batches():
+            if user_id is None:
+                if key in batch.nick_ids:
+                    return self.clusters.find(batch.nick_ids[key])
+            elif (key, user_id) in batch.nicks:
+                return user_id
+        return None
+
+    def _pending_vhost(self, vhost, user_id=None):
+        key = vhost.lower()
+        for batch in self._batches():
+            if user_id is None:
+                if key in batch.vhost_ids:
+                    return self.clusters.find(batch.vhost_ids[key])
+            elif (key, user_id) in batch.vhosts:
+                return user_id
+        return None
+
+    def _lookup_nick(self, nick, user_id=None):
+        """Returns a user id for nick, checking unwritten sightings first"""
+        pending = self._pending_nick(nick, user_id)
+        if pending is not None:
+            return pending
+        found = self.store.find('nick', nick, user_id)
+        return self.clusters.find(found.result())
+
+    def _lookup_vhost(self, vhost, user_id=None):
+        """Returns a user id for vhost, checking unwritten sightings first"""
+        pending = self._pending_vhost(vhost, user_id)
+        if pending is not None:
+            return pending
+        found = self.store.find('vhost', vhost, user_id)
+        return self.clusters.find(found.result())
+
+    def _maybe_flush(self):
+        if ((self.flush_interval <= 0) or
+           (len(self._batch) >= self.flush_size)):
+            self.flush()
 
+    @handler("flush_users")
+    def flush(self, wait=False):
+        """Hands all buffered sightings to the store as one write.
+
+        Returns a Future for the write, or None if nothing was pending.
+        With wait set, blocks until the store has written it and every
+        write and merge handed over before it.
+        """
+        future = None
+        if len(self._batch):
+            batch = self._batch
+            self._batch = _Batch()
+            self._inflight.append(batch)
+            future = self._last_write = self.store.write_batch(batch)
+            future.add_done_callback(partial(self._flushed, batch))
+        if wait and self._last_write is not None:
+            # Writes complete in order, so the last covers all of them
+            wait_futures([self._last_write])
+        return future
+
+    def _flushed(self, batch, future):
+        # May be called on a store thread
+        self._inflight.remove(batch)
+        if future.exception() is not None:
+            self.logger.error("Failed to write {} user sightings: {}"
+                              .format(len(batch), future.exception()))
+
+    def close(self):
+        """Writes everything pending and closes the store"""
+        self.flush()
+        self.store.close()
+
+    def _new_user(self, user):
         user_nick = user[0]
         user_host = user[1] + '@' + user[2]
         self.logger.info("NEW: Nick {}, Hostname {}"
                          .format(user_nick, user_host))
-        # New User
-        c.execute("""
-                  INSERT OR REPLACE INTO users (
-                      last_nick,
-                      last_vhost,
-                      modified,
-                      created
-                  ) VALUES(?, ?, ?, ?)
-                  """, (user_nick,
-                        user_host,
-                        datetime.utcnow(),
-                        datetime.utcnow()))
-        user_id = c.lastrowid
-        self.db_conn.commit()
+        # New User, written with the next flush
+        user_id = self._next_id
+        self._next_id += 1
+        now = int(time())
+        self._batch.new_users[user_id] = (user_id,
+                                          user_nick,
+                                          user_host,
+                                          now,
+                                          now)
         return user_id
 
-    def changed_nick(self, user, nick):
-        user_id = self.get_user_id(user)
-        self._update_nick(user_id, nick)
+    def changed_nick(self, user, nick, user_id=None, found=None):
+        """Records that user is now known as nick, returns the user id.
+
+        user_id and found, the result of a lookup_users() that included
+        nick, spare the lookups that would otherwise wait on the store.
+        """
+        if user_id is None:
+            user_id = self.get_user_id(user)
+        exists = None
+        if found is not None:
+            # A pair that's already there is only written again
+            exists = (self._pending_nick(nick, user_id) is not None or
+                      found[0].get(nick.lower()) == user_id)
+        self._update_nick(user_id, nick, exists)
+        self.cache.invalidate(user_id)
+        if (user[1] is not None) and (user[2] is not None):
+            self.cache.put((nick, user[1], user[2]), user_id)
         return user_id
 
+    def lazy_user(self, user):
+        """User for (nick, ident, host) whose id resolves when first read"""
+        return User(user[0], user[1], user[2], resolve=self.get_user_id)
+
     def get_full_user(self, nick=None, ident=None, hostname=None):
         user_id = self.get_user_id((nick, ident, hostname))
         return self.user_from_id(user_id)
@@ -152,7 +446,11 @@ class UserManager(Component):
            (user[1] is not None) and
            (user[2] is not None)):
             # Full user
-            return self.id_from_user(user)
+            user_id = self.cache.get(user)
+            if user_id is None:
+                user_id = self.id_from_user(user)
+                self.cache.put(user, user_id)
+            return user_id
         elif user[0] is not None:
             # Nick Only
             return self.id_from_nick(user[0])
@@ -163,79 +461,152 @@ class UserManager(Component):
             return None
 
     def id_from_user(self, user):
-        # User DB
-        c = self.db_conn.cursor()
-
         user_nick = user[0]
         user_host = user[1] + '@' + user[2]
 
         # Check what is and isn't already in the DB
-        c.execute("SELECT user_id FROM vhosts WHERE vhost=?", (user_host,))
-        id_vhost = c.fetchone()
-        c.execute("SELECT user_id FROM nicks WHERE nick=?", (user_nick,))
-        id_nick = c.fetchone()
+        id_vhost = self._lookup_vhost(user_host)
+        id_nick = self._lookup_nick(user_nick)
+
+        return self._resolve(user, id_nick, id_vhost)
+
+    def _resolve(self, user, id_nick, id_vhost, rows=None):
+        user_nick = user[0]
+        user_host = user[1] + '@' + user[2]
 
         # If Nick and Vhost are both new, add a new user
         if id_vhost is None and id_nick is None:
             user_id = self._new_user(user)
         elif id_vhost is None:
-            user_id = id_nick[0]
+            user_id = id_nick
         elif id_nick is None:
-            user_id = id_vhost[0]
+            user_id = id_vhost
         elif id_vhost == id_nick:
-            user_id = id_vhost[0]
+            user_id = id_vhost
         else:
-            # mismatched ids
-            # TODO do something here?
-            user_id = self._new_user(user)
+            # Nick and vhost belong to different users. Nicks prove
+            # nothing, so the vhost's user keeps its id; merging them is
+            # left to an admin
+            user_id = id_vhost
+            self.logger.info("MISMATCH: Nick {} is user {}, Hostname {} "
+                             "is user {}".format(user_nick, id_nick,
+                                                 user_host, id_vhost))
 
-        self._update_nick(user_id, user_nick)
-        self._update_vhost(user_id, user_host)
+        # Only rewrite the users row when something actually changed
+        last = self._last_seen(user_id, rows)
+        if id_nick != user_id or last is None or last[0] != user_nick:
+            self._update_nick(user_id, user_nick, id_nick == user_id)
+        if id_vhost != user_id or last is None or last[1] != user_host:
+            self._update_vhost(user_id, user_host, id_vhost == user_id)
 
         # all good, return ID
         return user_id
 
+    def lookup_users(self, users, nicks=()):
+        """Starts the store lookups ingest_users() needs for users.
+
+        nicks are looked up on top of theirs. Returns a Future for the
+        store's lookup_many(), which is done on a store thread: hand its
+        result to ingest_users() on the event loop, e.g. by firing an
+        event from its done callback. Cached users are looked up too, as
+        their entries may have expired by then.
+        """
+        return self.store.lookup_many(
+            set(user[0] for user in users) | set(nicks),
+            set(user[1] + '@' + user[2] for user in users))
+
+    def ingest_users(self, users, found):
+        """Resolves many (nick, ident, host) users at once.
+
+        Used for WHO replies: found is the result of lookup_users() for
+        users, so nothing here waits on the store, and every resulting
+        write goes out in a single flush. Returns the user ids in the
+        same order as users.
+        """
+        ids = [self.cache.get(user) for user in users]
+        if all(user_id is not None for user_id in ids):
+            return ids
+
+        nick_ids, vhost_ids, rows = found
+        # Filled in below, and maybe shared with other users of found
+        nick_ids = dict(nick_ids)
+        vhost_ids = dict(vhost_ids)
+        rows = dict(rows)
+        for index, user in enumerate(users):
+            if ids[index] is not None:
+                continue
+            user_host = user[1] + '@' + user[2]
+            # Earlier users in this batch may already have been written
+            id_nick = self._pending_nick(user[0])
+            if id_nick is None:
+                id_nick = self.clusters.find(nick_ids.get(user[0].lower()))
+            id_vhost = self._pending_vhost(user_host)
+            if id_vhost is None:
+                id_vhost = self.clusters.find(
+                    vhost_ids.get(user_host.lower()))
+            user_id = self._resolve(user, id_nick, id_vhost, rows)
+            self.cache.put(user, user_id)
+            ids[index] = user_id
+            # Stays visible even if a size triggered flush already wrote it
+            nick_ids.setdefault(user[0].lower(), user_id)
+            vhost_ids.setdefault(user_host.lower(), user_id)
+            rows[user_id] = (user[0], user_host)
+        self.flush()
+        return ids
+
     def id_from_nick(self, nick):
         self.logger.debug("Getting user id for %s" % nick)
-        c = self.db_conn.cursor()
-        c.execute("SELECT user_id FROM nicks WHERE nick=?", (nick,))
-        user_id = c.fetchone()
-        if user_id:
-            return user_id[0]
-        else:
-            return None
+        return self._lookup_nick(nick)
 
     def id_from_vhost(self, vhost):
         self.logger.debug("Getting user id for %s" % vhost)
-        c = self.db_conn.cursor()
-        c.execute("SELECT user_id FROM vhosts WHERE vhost=?", (vhost,))
-        user_id = c.fetchone()
-        if user_id:
-            return user_id[0]
+        return self._lookup_vhost(vhost)
+
+    def _last_seen(self, user_id, rows=None):
+        """Returns (last_nick, last_vhost), including unwritten updates
+
+        rows optionally maps user ids to rows already read from the DB.
+        """
+        last_nick = last_vhost = None
+        for batch in self._batches():
+            if last_nick is None and user_id in batch.last_nick:
+                last_nick = batch.last_nick[user_id][0]
+            if last_vhost is None and user_id in batch.last_vhost:
+                last_vhost = batch.last_vhost[user_id][0]
+            if user_id in batch.new_users:
+                row = batch.new_users[user_id][1:3]
+                break
         else:
-            return None
+            if last_nick is not None and last_vhost is not None:
+                return (last_nick, last_vhost)
+            if rows is not None:
+                row = rows.get(user_id)
+            else:
+                row = self.store.last_seen(user_id).result()
+            if row is None:
+                return None
+        return (last_nick or row[0], last_vhost or row[1])
 
     def user_from_id(self, user_id):
         self.logger.debug("Recreating user from ID %s" % user_id)
-        c = self.db_conn.cursor()
-        c.execute('SELECT last_nick, last_vhost FROM users WHERE id=?',
-                  (user_id,))
-        user_data = c.fetchone()
+        # Merged away ids stand for the id they were merged into
+        user_id = self.clusters.find(user_id)
+        user_data = self._last_seen(user_id)
         if user_data:
             split_vhost = user_data[1].split('@')
-            user = (user_data[0], split_vhost[0], split_vhost[1], user_id)
+            user = User(user_data[0], split_vhost[0], split_vhost[1], user_id)
             return user
         else:
             return None
 
     def merge_users(self, user1, user2):
         """Merges users, by full user or by nick"""
-        if isinstance(user1, tuple):
+        if not isinstance(user1, str):
             id1 = user1[3]
         else:
             id1 = self.id_from_nick(user1)
 
-        if isinstance(user2, tuple):
+        if not isinstance(user2, str):
             id2 = user2[3]
         else:
             id2 = self.id_from_nick(user2)
@@ -244,22 +615,42 @@ class UserManager(Component):
 
     def get_ids(self):
         """Returns all user ids"""
-        c = self.db_conn.cursor()
-        c.execute('SELECT id FROM users')
-        ids = c.fetchall()
-        print(ids)
-        return ids
+        self.flush(wait=True)
+        return self.store.ids().result()
+
+    def iter_users(self, offset=0, limit=None, filter=None, page_size=100):
+        """Yields (nick, ident, host, id) Users ordered by id.
+
+        Pages through the DB by id (keyset pagination), so memory stays
+        bounded by page_size however large the database is. offset is the
+        id to continue after, usually the last id previously yielded.
+        filter is a * and ? wildcard mask matched against every nick a
+        user has been seen with.
+        """
+        self.flush(wait=True)
+        after = offset
+        remaining = limit
+        while remaining is None or remaining > 0:
+            count = page_size
+            if remaining is not None:
+                count = min(count, remaining)
+            rows = self.store.users_page(after, count, filter).result()
+            for user_id, last_nick, last_vhost in rows:
+                ident, _, host = (last_vhost or '').partition('@')
+                yield User(last_nick, ident, host, user_id)
+            if len(rows) < count:
+                return
+            after = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
 
     def merge_ids(self, id1, id2):
-        if id1 > id2:
-            user_from = self.user_from_id(id1)
-            user_to = self.user_from_id(id2)
-        elif id1 < id2:
-            user_from = self.user_from_id(id2)
-            user_to = self.user_from_id(id1)
-        else:
+        id1 = self.clusters.find(id1)
+        id2 = self.clusters.find(id2)
+        if id1 == id2:
             return False
-
+        user_from = self.user_from_id(max(id1, id2))
+        user_to = self.user_from_id(min(id1, id2))
         if (user_to is None) or (user_from is None):
             return False
 
@@ -268,19 +659,55 @@ class UserManager(Component):
                                   user_from[3],
                                   user_to[0],
                                   user_to[3]))
-        c = self.db_conn.cursor()
-        c.execute("""
-                  UPDATE nicks SET
-                      user_id=?,
-                      modified=?
-                  WHERE user_id=?
-                  """, (user_to[3], datetime.utcnow(), user_from[3]))
-        c.execute("""
-                  UPDATE vhosts SET
-                      user_id=?,
-                      modified=?
-                  WHERE user_id=?
-                  """, (user_to[3], datetime.utcnow(), user_from[3]))
-        c.execute("DELETE FROM users WHERE id=?", (user_from[3],))
-        self.db_conn.commit()
+        self.merge_cluster((id1, id2))
         return True
+
+    def merge_cluster(self, ids):
+        """Merges every id in ids into the lowest one and returns it.
+
+        Lookups resolve through the identity clusters right away; the
+        rows are moved by the store in a single transaction after any
+        pending sightings.
+        """
+        root, merged = self.clusters.union(ids)
+        if merged:
+            self._apply_merges(dict((from_id, root) for from_id in merged))
+        return root
+
+    def compact_identities(self):
+        """Merges every group of users sharing a vhost.
+
+        Shared nicks are left alone, as anyone can take a nick; those
+        users are only merged by an explicit merge_ids().
+
+        Returns how many user records were merged away.
+        """
+        self.flush()
+        groups = self.store.shared_ids().result()
+        merges = {}
+        for group in groups:
+            root, merged = self.clusters.union(group)
+            for from_id in merged:
+                merges[from_id] = root
+        # Earlier roots may have been merged again by a later group
+        for from_id in merges:
+            merges[from_id] = self.clusters.find(from_id)
+        if merges:
+            self.logger.info("COMPACT: Merging {} user records."
+                             .format(len(merges)))
+            self._apply_merges(merges)
+        return len(merges)
+
+    def _apply_merges(self, merges):
+        self.flush()
+        for user_id in set(merges) | set(merges.values()):
+            self.cache.invalidate(user_id)
+        future = self._last_write = self.store.merge(merges, int(time()))
+        future.add_done_callback(self._merged)
+        return future
+
+    def _merged(self, future):
+        # May be called on a store thread
+        if future.exception() is not None:
+            self.logger.error("Failed to merge users: {}"
+                              .format(future.exception()))
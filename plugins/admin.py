@@ -15,22 +15,25 @@ class AdminPlugin(BasePlugin):
         super(AdminPlugin, self).init(bot, *args, **kwargs)
         self.logger = logging.getLogger(__name__)
         self.admin_id = 1
+        # Most users listed per ~ids call
+        self.ids_limit = 10
+        self.actions = {
+            'load': self._load,
+            'unload': self._unload,
+            'query': self._query,
+            'merge': self._merge,
+            'ids': self._ids,
+            'compact': self._compact,
+            'queue': self._queue_stats,
+        }
 
-    def on_text(self, user, target, args):
-        if (user[3] == self.admin_id) and (args.startswith('~')):
-            args = args.split(' ')
-            command = args[0][1:]
-            args = args[1:]
-            if command == "load":
-                return self._load(user, target, args)
-            elif command == "unload":
-                return self._unload(user, target, args)
-            elif command == "query":
-                return self._query(user, target, args)
-            elif command == "merge":
-                return self._merge(user, target, args)
-            elif command == "ids":
-                return self._ids(user, target, args)
+    def on_command(self, user, target, command):
+        # Check the command first, so chatter doesn't look up user ids
+        if not command.admin:
+            return
+        action = self.actions.get(command.name)
+        if action is not None and user[3] == self.admin_id:
+            return action(user, target, command.args)
 
 #####################
 # Plugin Management #
@@ -80,19 +83,59 @@ class AdminPlugin(BasePlugin):
             self.reply(user, target, "Unable to Query plugins. {}"
                                      .format(e))
 
+    def _queue_stats(self, user, target, args):
+        stats = self.bot.send_queue.stats()
+        self.reply(user, target, "Send queue: {queued} lines "
+                                 "({lanes[0]} protocol, "
+                                 "{lanes[1]} moderation, "
+                                 "{lanes[2]} reply, {lanes[3]} bulk) for "
+                                 "{targets} targets, {sent} sent, "
+                                 "{dropped} dropped ({collapsed} "
+                                 "duplicates), {expired} expired, "
+                                 "waited {wait_avg:.1f}s avg, "
+                                 "{wait_max:.1f}s max, "
+                                 "oldest {oldest:.1f}s."
+                                 .format(**stats))
+
 #####################
 # User Management #
 #####################
 
     def _ids(self, user, target, args):
-        ids = self.bot.user_mngr.get_ids()
-        for user_id in ids:
-            user_info = self.bot.user_mngr.user_from_id(user_id[0])
+        """Usage: ids [nick mask] [start after id]"""
+        nick_filter = None
+        offset = 0
+        for arg in args:
+            if arg.isdigit():
+                offset = int(arg)
+            elif arg:
+                nick_filter = arg
+        listed = 0
+        last_id = offset
+        for user_info in self.bot.user_mngr.iter_users(offset,
+                                                       self.ids_limit + 1,
+                                                       nick_filter):
+            if listed == self.ids_limit:
+                self.reply(user, target, "More: {}ids {}{}"
+                                         .format(self.bot.admin_prefix,
+                                                 nick_filter + ' '
+                                                 if nick_filter else '',
+                                                 last_id))
+                break
             self.reply(user, target, "{} : {}!{}@{}"
                                      .format(user_info[3],
                                              user_info[0],
                                              user_info[1],
                                              user_info[2]))
+            listed += 1
+            last_id = user_info[3]
+        if not listed:
+            self.reply(user, target, "No users found.")
+
+    def _compact(self, user, target, args):
+        merged = self.bot.user_mngr.compact_identities()
+        self.reply(user, target, "Compacted {} duplicate user records."
+                                 .format(merged))
 
     def _merge(self, user, target, args):
         if len(args) != 2:
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import time
 
 from circuits import handler
 
@@ -26,7 +27,24 @@ class ExamplePlugin(BasePlugin):
                                  .format(user[0], user[3]))
         self.logger.info("Test Fired by {} (ID {}) in {}: {}"
                          .format(user[0], user[3], target, message))
-    test_command.commands = ['test', 't']
+    test_command.commands = ['test']
+
+    def sleep_command(self, user, target, message):
+        """Sleeps without holding up the bot, then says so.
+        Usage: sleep seconds"""
+        # Commands doing slow work, such as disk or network I/O, can set
+        # threaded to run in the command pool instead of the event loop.
+        # Whatever they return is sent as the reply, and if they take
+        # longer than timeout seconds "timed out" is replied instead.
+        try:
+            seconds = float(message)
+        except ValueError:
+            return "Invalid number of seconds"
+        time.sleep(seconds)
+        return "Slept for {} seconds".format(seconds)
+    sleep_command.commands = ['sleep']
+    sleep_command.threaded = True
+    sleep_command.timeout = 5.0
 
     #########################################################################
     # ----------------------------- Commands ------------------------------ #
@@ -229,7 +247,7 @@ class ExamplePlugin(BasePlugin):
         """on_action Event
         /me or /describe event received.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             target - string - Channel or User message was sent to.
             message - string - Full message received.
         """
@@ -243,7 +261,7 @@ class ExamplePlugin(BasePlugin):
         """on_ban Event
         User banned from a channel
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             target - string - Banned target.
             channel - string - Channel target is banned from.
         """
@@ -251,6 +269,21 @@ class ExamplePlugin(BasePlugin):
                                                           target,
                                                           channel))
 
+    def on_command(self, user, target, command):
+        """on_command Event
+        Received a message starting with the command prefix, the admin
+        prefix or the bot's nick. Commands are already dispatched to
+        their handlers, this is for plugins that want to see them all.
+        Args:
+            user - User - (nickname, ident, hostname, user id)
+            target - string - Channel or User that message was sent to.
+            command - ParsedCommand - name, text and args of the command.
+        """
+        self.logger.info("COMMAND: {}@{}: {} {}".format(user[0],
+                                                        target,
+                                                        command.name,
+                                                        command.args))
+
     def on_connect(self, network, port):
         """on_connect Event
         Successfully connected to IRC server and recieved it's MOTD.
@@ -265,8 +298,8 @@ class ExamplePlugin(BasePlugin):
         """on_deop Event
         User has taken away operator privileges from target in channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
-            target - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
+            target - User - (nickname, ident, hostname, user id)
             channel - string - Channel target is no longer operator of.
         """
         self.logger.info("DEOP: {} deopped {} in {}".format(user[0],
@@ -277,8 +310,8 @@ class ExamplePlugin(BasePlugin):
         """on_deowner Event
         User has taken away owner privileges from target in channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
-            target - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
+            target - User - (nickname, ident, hostname, user id)
             channel - string - Channel target is no longer owner of.
         """
         self.logger.info("DEOWNER: {} deownered {} in {}".format(user[0],
@@ -289,8 +322,8 @@ class ExamplePlugin(BasePlugin):
         """on_devoice Event
         User has taken away voice privileges from target in channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
-            target - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
+            target - User - (nickname, ident, hostname, user id)
             channel - string - Channel target is no longer voiced in.
         """
         self.logger.info("DEVOICE: {} devoiced {} in {}".format(user[0],
@@ -313,7 +346,7 @@ class ExamplePlugin(BasePlugin):
         """on_invite Event
         Received invite to join a channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             channel - string - Channel we've been invited to.
         """
         self.logger.info("INVITE: {} invited us to {}".format(user[0],
@@ -323,7 +356,7 @@ class ExamplePlugin(BasePlugin):
         """on_join Event
         User joined a channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             channel - string - Channel target was kicked from.
         """
         self.logger.info("JOIN: {} has joined {}".format(user[0],
@@ -333,8 +366,8 @@ class ExamplePlugin(BasePlugin):
         """on_kick Event
         User kicked from a channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
-            target - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
+            target - User - (nickname, ident, hostname, user id)
             channel - string - Channel target was kicked from.
             message - string - Kick message.
         """
@@ -357,7 +390,7 @@ class ExamplePlugin(BasePlugin):
         """on_mode Event
         A channel mode has been changed.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             mode - string - Channel or user mode set.
             target - string - Chennel or Nickname affected.
         """
@@ -369,7 +402,7 @@ class ExamplePlugin(BasePlugin):
         """on_nick Event
         A user in a channel has changed their nick.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             new_nick - string - The new nickname.
         """
         self.logger.info("NICK: {} changed nick to {}".format(user[0],
@@ -379,7 +412,7 @@ class ExamplePlugin(BasePlugin):
         """on_notice Event
         Received a notice message.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             target - string - Channel or User that message was sent to.
             message - string - Full message received.
         """
@@ -391,8 +424,8 @@ class ExamplePlugin(BasePlugin):
         """on_op Event
         User has given target operator privileges in channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
-            target - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
+            target - User - (nickname, ident, hostname, user id)
             channel - string - Channel target is operator of.
         """
         self.logger.info("OP: {} opped {} in {}".format(user[0],
@@ -403,8 +436,8 @@ class ExamplePlugin(BasePlugin):
         """on_owner Event
         User has given owner privileges from target in channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
-            target - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
+            target - User - (nickname, ident, hostname, user id)
             channel - string - Channel target is owner of.
         """
         self.logger.info("OWNER: {} ownered {} in {}".format(user[0],
@@ -415,7 +448,7 @@ class ExamplePlugin(BasePlugin):
         """on_part Event
         A user in a channel has parted the channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             channel - string - Channel that the user parted from.
             message - string - Part message.
         """
@@ -427,7 +460,7 @@ class ExamplePlugin(BasePlugin):
         """on_quit Event
         A user in a channel has quit IRC.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             message - string - Quit message.
         """
         self.logger.info("QUIT: {} has quit: {}".format(user[0],
@@ -443,7 +476,7 @@ class ExamplePlugin(BasePlugin):
         """on_text Event
         Received private or channel message.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             target - string - Channel or User that message was sent to.
             message - string - Full message received.
         """
@@ -455,7 +488,7 @@ class ExamplePlugin(BasePlugin):
         """on_topic Event
         A user has changed the topic of a channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             channel - string - Channel that the topic was changed.
             topic - string - The new topic.
         """
@@ -467,7 +500,7 @@ class ExamplePlugin(BasePlugin):
         """on_unban Event
         A user has been unbaned from a channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
             target - string - Unbanned target.
             channel - string - Channel target is unbanned from.
         """
@@ -479,8 +512,8 @@ class ExamplePlugin(BasePlugin):
         """on_voice Event
         User has given target voice privileges in channel.
         Args:
-            user - tuple - (nickname, ident, hostname, user id)
-            target - tuple - (nickname, ident, hostname, user id)
+            user - User - (nickname, ident, hostname, user id)
+            target - User - (nickname, ident, hostname, user id)
             channel - string - Channel target is voiced in.
         """
         self.logger.info("VOICE: {} voiced {} in {}".format(user[0],